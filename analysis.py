@@ -0,0 +1,385 @@
+from dataclasses import dataclass
+
+from charclass import CharClass
+from compiled import CompiledAutomaton
+
+# Label of edges that do not consume a character
+EPSILON = -1
+
+
+@dataclass
+class RunGraph:
+    """
+    The runs of a compiled automaton as a plain graph. Nodes `0..size-1` are
+    the states and node `size + i` is the moment right after taking edge `i`.
+    They are followed by the start node, a `source` and a `sink`. Edges into
+    edge nodes are labelled with the class id of the edge, all others are
+    labelled `EPSILON`.
+    """
+
+    auto: CompiledAutomaton
+    successors: list[list[tuple[int, int]]]
+    predecessors: list[list[tuple[int, int]]]
+    source: int
+    sink: int
+
+    @staticmethod
+    def build(auto: CompiledAutomaton) -> "RunGraph":
+        n = auto.size
+        start = n + len(auto.edges)
+        source, sink = start + 1, start + 2
+        successors = [[] for _ in range(sink + 1)]
+        for s in range(n):
+            for i in range(auto.offsets[s], auto.offsets[s + 1]):
+                successors[s].append((ord(auto.edges[i]), n + i))
+                successors[n + i] = [
+                    (EPSILON, t) for t in sorted(auto.closures[auto.targets[i]])
+                ]
+            if auto.accept >> s & 1:
+                successors[s].append((EPSILON, sink))
+        successors[start] = [(EPSILON, t) for t in sorted(auto.start_states())]
+        successors[source] = [(EPSILON, start)]
+        predecessors = [[] for _ in range(sink + 1)]
+        for node, out in enumerate(successors):
+            for label, target in out:
+                predecessors[target].append((label, node))
+        return RunGraph(auto, successors, predecessors, source, sink)
+
+    def dominator_chain(self) -> list[int] | None:
+        """
+        Nodes that every accepting run passes through, in the order they are
+        visited (Cooper-Harvey-Kennedy). `None` if nothing can be accepted.
+        """
+        postorder = []
+        seen = {self.source}
+        work = [(self.source, iter(self.successors[self.source]))]
+        while work:
+            node, it = work[-1]
+            for _, n in it:
+                if n not in seen:
+                    seen.add(n)
+                    work.append((n, iter(self.successors[n])))
+                    break
+            else:
+                work.pop()
+                postorder.append(node)
+        if self.sink not in seen:
+            return None
+
+        number = {n: i for i, n in enumerate(postorder)}
+        idom = {self.source: self.source}
+
+        def intersect(a: int, b: int) -> int:
+            while a != b:
+                while number[a] < number[b]:
+                    a = idom[a]
+                while number[b] < number[a]:
+                    b = idom[b]
+            return a
+
+        changed = True
+        while changed:
+            changed = False
+            for n in reversed(postorder):
+                if n == self.source:
+                    continue
+                new_idom = None
+                for _, p in self.predecessors[n]:
+                    if p in idom:
+                        new_idom = p if new_idom is None else intersect(p, new_idom)
+                if idom.get(n) != new_idom:
+                    idom[n] = new_idom
+                    changed = True
+
+        chain = []
+        n = idom[self.sink]
+        while n != self.source:
+            chain.append(n)
+            n = idom[n]
+        return chain[::-1]
+
+    def last_edges(self, node: int) -> set[int] | None:
+        """
+        The edge nodes one of which was taken last whenever a run is at
+        `node`, `None` if `node` can be reached without consuming anything.
+        """
+        n = self.auto.size
+        if n <= node < n + len(self.auto.edges):
+            return {node}
+        edges = {p for _, p in self.predecessors[node]}
+        if not edges or not all(n <= p < n + len(self.auto.edges) for p in edges):
+            return None
+        return edges
+
+    def entry_char(self, node: int) -> str | None:
+        """The character that is always consumed right before `node`."""
+        edges = self.last_edges(node)
+        if edges is None:
+            return None
+        labels = {label for e in edges for label, _ in self.predecessors[e]}
+        if len(labels) != 1:
+            return None
+        return _single_char(self.auto.class_sets[labels.pop()])
+
+    def entered_from(self, node: int) -> set[int]:
+        """The edge nodes whose characters can come right before `node`."""
+        result = set()
+        for _, state in self.predecessors[node]:
+            result.update(p for _, p in self.predecessors[state])
+        return result
+
+    def on_cycle(self, node: int) -> bool:
+        front = [t for _, t in self.successors[node]]
+        seen = set(front)
+        while front:
+            n = front.pop()
+            if n == node:
+                return True
+            for _, t in self.successors[n]:
+                if t not in seen:
+                    seen.add(t)
+                    front.append(t)
+        return False
+
+    def longest_prefix(self, target: int) -> int | None:
+        """
+        The most characters a run can consume before entering `target` for
+        the first time, `None` if that is unbounded.
+        """
+        # Everything that leads to `target` without passing it
+        relevant = {self.source}
+        front = [p for _, p in self.predecessors[target]]
+        relevant.update(front)
+        while front:
+            for _, p in self.predecessors[front.pop()]:
+                if p not in relevant and p != target:
+                    relevant.add(p)
+                    front.append(p)
+
+        # Longest paths in topological order, a cycle makes it unbounded
+        indegree = {n: 0 for n in relevant}
+        for n in relevant:
+            for _, t in self.successors[n]:
+                if t in relevant:
+                    indegree[t] += 1
+        longest = {n: -1 for n in relevant}
+        longest[self.source] = 0
+        ready = [n for n, degree in indegree.items() if degree == 0]
+        done = 0
+        while ready:
+            n = ready.pop()
+            done += 1
+            for label, t in self.successors[n]:
+                if t not in relevant:
+                    continue
+                if longest[n] >= 0:
+                    weight = 0 if label == EPSILON else 1
+                    longest[t] = max(longest[t], longest[n] + weight)
+                indegree[t] -= 1
+                if indegree[t] == 0:
+                    ready.append(t)
+        if done < len(relevant):
+            return None
+        return max([0] + [longest[p] for _, p in self.predecessors[target]])
+
+
+@dataclass(frozen=True, slots=True)
+class Prefilter:
+    """
+    Literal substrings that every match contains, in this order and without
+    overlapping. `max_prefix` is the most characters a match can have before
+    the first literal, `None` if that is unbounded.
+    """
+
+    literals: tuple[str, ...]
+    max_prefix: int | None
+
+    @staticmethod
+    def from_automaton(auto: CompiledAutomaton) -> "Prefilter | None":
+        graph = RunGraph.build(auto)
+        chain = graph.dominator_chain()
+        if not chain:
+            return None
+
+        literals = []
+        first = None
+        current, prev = "", None
+        for node in chain:
+            edges = graph.last_edges(node)
+            if edges and prev and edges & prev:
+                # Possibly the character that was just added, e.g. a state
+                # right after the edge that entered it
+                continue
+            char = graph.entry_char(node)
+            if char is None:
+                if current:
+                    literals.append(current)
+                current, prev = "", None
+                continue
+            if current and all(graph.entered_from(e) <= prev for e in edges):
+                current += char
+            else:
+                # Either a gap or a loop back into `node`, only the last
+                # character is known to come right before the next one
+                if current:
+                    literals.append(current)
+                current = char
+                if first is None:
+                    first = node
+            prev = edges
+        if current:
+            literals.append(current)
+        if not literals:
+            return None
+        # The first literal is only known to start where `first` is passed,
+        # which has to happen exactly once to bound what comes before it
+        max_prefix = None
+        if not graph.on_cycle(first):
+            max_prefix = graph.longest_prefix(first)
+            if max_prefix is not None and first < auto.size:
+                # Entering a state already consumed its character
+                max_prefix -= 1
+        return Prefilter(tuple(literals), max_prefix)
+
+    def find(self, haystack: str) -> int:
+        """
+        -1 if `haystack` cannot contain a match, otherwise the earliest
+        position a match can start at.
+        """
+        pos = 0
+        first = -1
+        for literal in self.literals:
+            pos = haystack.find(literal, pos)
+            if pos < 0:
+                return -1
+            if first < 0:
+                first = pos
+            pos += len(literal)
+        if self.max_prefix is None:
+            return 0
+        return max(0, first - self.max_prefix)
+
+
+def _single_char(cls: CharClass) -> str | None:
+    if len(cls.ranges) == 1 and cls.ranges[0][0] == cls.ranges[0][1]:
+        return chr(cls.ranges[0][0])
+    return None
+
+
+def literal_string(auto: CompiledAutomaton) -> str | None:
+    """The string if `auto` accepts exactly one string, e.g. `(ab)c{2}`."""
+    chars = []
+    states = auto.start_states()
+    # A literal visits every state at most once
+    for _ in range(auto.size + 1):
+        edges = [i for s in states for i in range(auto.offsets[s], auto.offsets[s + 1])]
+        if not edges:
+            return "".join(chars) if auto.accepts(states) else None
+        if len(edges) > 1 or auto.accepts(states):
+            return None
+        char = _single_char(auto.class_sets[ord(auto.edges[edges[0]])])
+        if char is None:
+            return None
+        chars.append(char)
+        states = auto.closures[auto.targets[edges[0]]]
+    return None
+
+
+def single_class(auto: CompiledAutomaton) -> CharClass | None:
+    """The characters if `auto` accepts exactly the strings of length one."""
+    start = auto.start_states()
+    if auto.accepts(start):
+        return None
+    edges = [i for s in start for i in range(auto.offsets[s], auto.offsets[s + 1])]
+    targets = {auto.targets[i] for i in edges}
+    if len(targets) != 1:
+        return None
+    after = auto.closures[targets.pop()]
+    if not auto.accepts(after) or any(
+        auto.offsets[s] != auto.offsets[s + 1] for s in after
+    ):
+        return None
+    return CharClass.from_ranges(
+        [r for i in edges for r in auto.class_sets[ord(auto.edges[i])].ranges]
+    )
+
+
+def length_bounds(auto: CompiledAutomaton) -> tuple[int, int | None] | None:
+    """
+    The shortest and longest accepted string, the longest is `None` if it is
+    unbounded. `None` if nothing is accepted.
+    """
+    successors = [set() for _ in range(auto.size)]
+    for s in range(auto.size):
+        for i in range(auto.offsets[s], auto.offsets[s + 1]):
+            successors[s] |= auto.closures[auto.targets[i]]
+
+    # Shortest: breadth-first over the number of characters read, the search
+    # goes on to find every reachable state
+    distance = {s: 0 for s in auto.start_states()}
+    front = list(distance)
+    shortest = None
+    while front:
+        if shortest is None and any(auto.accept >> s & 1 for s in front):
+            shortest = distance[front[0]]
+        next_front = []
+        for s in front:
+            for t in successors[s]:
+                if t not in distance:
+                    distance[t] = distance[s] + 1
+                    next_front.append(t)
+        front = next_front
+    if shortest is None:
+        return None
+
+    # Longest: only states that lie on an accepting run matter, a cycle
+    # among them makes the length unbounded
+    predecessors = [[] for _ in range(auto.size)]
+    for s, targets in enumerate(successors):
+        for t in targets:
+            predecessors[t].append(s)
+    useful = {s for s in range(auto.size) if auto.accept >> s & 1}
+    front = list(useful)
+    while front:
+        for p in predecessors[front.pop()]:
+            if p not in useful:
+                useful.add(p)
+                front.append(p)
+    useful &= set(distance)
+    indegree = {s: 0 for s in useful}
+    for s in useful:
+        for t in successors[s] & useful:
+            indegree[t] += 1
+    longest = {s: 0 if s in auto.start_states() else -1 for s in useful}
+    ready = [s for s, degree in indegree.items() if degree == 0]
+    done = 0
+    while ready:
+        s = ready.pop()
+        done += 1
+        for t in successors[s] & useful:
+            if longest[s] >= 0:
+                longest[t] = max(longest[t], longest[s] + 1)
+            indegree[t] -= 1
+            if indegree[t] == 0:
+                ready.append(t)
+    if done < len(useful):
+        return shortest, None
+    return shortest, max(longest[s] for s in useful if auto.accept >> s & 1)
+
+
+def first_chars(auto: CompiledAutomaton) -> CharClass | None:
+    """
+    The characters a non-empty match can start with, `None` if the empty
+    string is accepted as well.
+    """
+    start = auto.start_states()
+    if auto.accepts(start):
+        return None
+    return CharClass.from_ranges(
+        [
+            r
+            for s in start
+            for i in range(auto.offsets[s], auto.offsets[s + 1])
+            for r in auto.class_sets[ord(auto.edges[i])].ranges
+        ]
+    )
@@ -2,6 +2,8 @@ from dataclasses import dataclass, field
 from collections import defaultdict
 import typing
 
+from charclass import ANY, CharClass
+
 last_id = 0
 
 
@@ -17,13 +19,24 @@ class Node:
         default_factory=lambda: defaultdict(set)
     )
     trivial_neigbours: set["Node"] = field(default_factory=set)
-    negative_match: list[tuple[set[str], "Node"]] = field(default_factory=list)
+    classes: list[tuple[CharClass, "Node"]] = field(default_factory=list)
     _id: int = field(default_factory=get_id)
+    # Filled in by optimizer.compute_closures
+    closure: frozenset["Node"] = frozenset()
+    # Capture slot that records the position when a match passes this node
+    tag: int | None = None
+    # Marker nodes of a counted repetition, see `Counter`
+    enters: typing.Optional["Counter"] = None
+    leaves: typing.Optional["Counter"] = None
+    # Marker nodes of a shared variable, see `Call`
+    calls: typing.Optional[tuple["Call", int]] = None
+    returns: typing.Optional["Call"] = None
 
     def match(self, char: str) -> set["Node"]:
-        result = self.transitions[char]
-        for dont_match, node in self.negative_match:
-            if char not in dont_match:
+        """The nodes `char` leads to, without changing this node."""
+        result = set(self.transitions.get(char, ()))
+        for cls, node in self.classes:
+            if char in cls:
                 result.add(node)
         return result
 
@@ -34,10 +47,13 @@ class Node:
         self.transitions[char].add(n)
 
     def connect_dot(self, n: "Node"):
-        self.negative_match.append((set(), n))
+        self.classes.append((ANY, n))
 
     def connect_neg(self, neg: set[str], n: "Node"):
-        self.negative_match.append((neg, n))
+        self.classes.append((CharClass.from_chars("".join(neg)).negate(), n))
+
+    def connect_class(self, cls: CharClass, n: "Node"):
+        self.classes.append((cls, n))
 
     def __hash__(self) -> int:
         return self._id
@@ -46,6 +62,77 @@ class Node:
         return self._id == o._id
 
 
+@dataclass(eq=False)
+class Counter:
+    """
+    A{min,max} with a single copy of A, which starts at `body`. A run
+    that passes a node that `enters` the counter goes on at `body` with a
+    count of 0. Reaching a node that `leaves` it finishes one more pass
+    through A: the run goes on at `body` again while fewer than `max` passes
+    are done, and at `exit` once at least `min` are. Neither marker has
+    edges of its own, what a marker leads to depends on the count.
+    """
+
+    min: int
+    max: int
+    body: Node
+    exit: Node
+
+
+@dataclass(eq=False)
+class Call:
+    """
+    The one copy of a variable that all references to it share, which starts
+    at `body`. A run that passes a node that `calls` it as site `j` goes on
+    at `body` and remembers `j`, and reaching the node that `returns` from it
+    goes on at `exits[j]`. Like the markers of a `Counter`, neither marker
+    has edges of its own. Variables can't refer to themselves, so a run is
+    never inside the same call twice.
+    """
+
+    body: Node
+    exits: list[Node]
+
+
+def marker_targets(node: Node, calls: bool = True) -> list[Node]:
+    """
+    The nodes a marker node can lead to, whatever the counts and sites. With
+    `calls` false a site leads straight to its exit, past the shared body.
+    """
+    if node.enters is not None:
+        return [node.enters.body]
+    if node.leaves is not None:
+        return [node.leaves.body, node.leaves.exit]
+    if node.calls is not None:
+        call, site = node.calls
+        return [call.body] if calls else [call.exits[site]]
+    if node.returns is not None:
+        return list(node.returns.exits) if calls else []
+    return []
+
+
+def marker_weights(nodes: list[Node]) -> dict[Counter | Call, int]:
+    """
+    The place value of each counter's count and each call's site in the index
+    that combines them all. Counts range from 0 to `max - 1` and sites, plus
+    one to leave 0 for outside the call, from 1 to `len(exits)`. Every
+    counter and call gets digits of its own, in the order of `nodes`, so a
+    call can be entered from inside any counter or other call.
+    """
+    weights = {}
+    weight = 1
+    for node in nodes:
+        call = node.returns or (node.calls[0] if node.calls is not None else None)
+        for slot in (node.enters or node.leaves, call):
+            if slot is not None and slot not in weights:
+                weights[slot] = weight
+                if isinstance(slot, Counter):
+                    weight *= slot.max
+                else:
+                    weight *= len(slot.exits) + 1
+    return weights
+
+
 @dataclass
 class Automaton:
     start: Node = field(default_factory=Node)
@@ -67,6 +154,19 @@ class Automaton:
         result.start.connect_literal(lit, result.end)
         return result
 
+    @staticmethod
+    def trie(words: list[str]) -> "Automaton":
+        """`(word1|word2|...)` with shared prefixes sharing their nodes."""
+        result = Automaton()
+        for word in words:
+            node = result.start
+            for char in word:
+                if not node.transitions[char]:
+                    node.connect_literal(char, Node())
+                node = next(iter(node.transitions[char]))
+            node.connect_trivial(result.end)
+        return result
+
     def clone(self) -> "Automaton":
         clone_lib = dict()
         self.start.rebuild(clone_lib)
@@ -76,31 +176,75 @@ class Automaton:
         return Automaton(new_start, new_end)
 
     def clone(self) -> "Automaton":
-        new_start = Node()
-        old_to_new = {self.start: new_start}  # Copied equivalent of the old node
-        front = {self.start}
-        while front:
-            current_node = front.pop()
-            current_new = old_to_new[current_node]
-            for literal, nodes in current_node.transitions.items():
-                # Make transitions equivalent to old ones
-                for node in nodes:
-                    if node not in old_to_new:
-                        front.add(node)
-                        old_to_new[node] = Node()
-                    current_new.transitions[literal].add(old_to_new[node])
-            for node in current_node.trivial_neigbours:
-                # Match trivial neighbours equivalent to old ones
-                if node not in old_to_new:
-                    front.add(node)
-                    old_to_new[node] = Node()
-                current_new.trivial_neigbours.add(old_to_new[node])
-            for neg_match, node in current_node.negative_match:
-                if node not in old_to_new:
-                    front.add(node)
-                    old_to_new[node] = Node()
-                current_new.negative_match.append((neg_match, old_to_new[node]))
-        return Automaton(new_start, old_to_new[self.end])
+        # Copies are created in the order of the originals, which is the
+        # priority order of `pikevm.PikeVM`. Shared variables aren't copied,
+        # the copy of a site is one more site of the same call.
+        nodes = sorted(
+            reachable(self.start, calls=False) | {self.end}, key=lambda n: n._id
+        )
+        old_to_new = {node: Node(tag=node.tag) for node in nodes}
+        counters = {}
+        for node in nodes:
+            new = old_to_new[node]
+            if node.calls is not None:
+                call, site = node.calls
+                new.calls = call, len(call.exits)
+                call.exits.append(old_to_new[call.exits[site]])
+            for counter in (node.enters, node.leaves):
+                if counter is not None and counter not in counters:
+                    counters[counter] = Counter(
+                        counter.min,
+                        counter.max,
+                        old_to_new[counter.body],
+                        old_to_new[counter.exit],
+                    )
+            new.enters = counters.get(node.enters)
+            new.leaves = counters.get(node.leaves)
+            for literal, targets in node.transitions.items():
+                for target in targets:
+                    new.transitions[literal].add(old_to_new[target])
+            for target in node.trivial_neigbours:
+                new.trivial_neigbours.add(old_to_new[target])
+            for cls, target in node.classes:
+                new.classes.append((cls, old_to_new[target]))
+        return Automaton(old_to_new[self.start], old_to_new[self.end])
+
+    def reverse(self) -> "Automaton":
+        """
+        The automaton of the reversed strings, with every edge turned around.
+        A counted repetition is entered from its old exit, runs through the
+        reversed body and leaves into what entered it before, and so is a call
+        from each of its old exits, returning to what its site was entered
+        from.
+        """
+        nodes = sorted(reachable(self.start) | {self.end}, key=lambda n: n._id)
+        new = {node: Node() for node in nodes}
+        entered_at = {node.enters: node for node in nodes if node.enters is not None}
+        sites = defaultdict(list)
+        for node in nodes:
+            if node.calls is not None:
+                sites[node.calls[0]].append(node)
+        for node in nodes:
+            if node.returns is not None:
+                old = node.returns
+                call = Call(new[node], [new[site] for site in sites[old]])
+                new[old.body].connect_trivial(Node(returns=call))
+                for idx, site in enumerate(sites[old]):
+                    exit = new[old.exits[site.calls[1]]]
+                    exit.connect_trivial(Node(calls=(call, idx)))
+            if node.leaves is not None:
+                old = node.leaves
+                counter = Counter(old.min, old.max, new[node], new[entered_at[old]])
+                new[old.exit].connect_trivial(Node(enters=counter))
+                new[old.body].connect_trivial(Node(leaves=counter))
+            for char, targets in node.transitions.items():
+                for target in targets:
+                    new[target].connect_literal(char, new[node])
+            for target in node.trivial_neigbours:
+                new[target].connect_trivial(new[node])
+            for cls, target in node.classes:
+                new[target].connect_class(cls, new[node])
+        return Automaton(new[self.end], new[self.start])
 
     def concat(self, other: "Automaton") -> "Automaton":
         self.end.connect_trivial(other.start)
@@ -119,6 +263,26 @@ class Automaton:
         self.end.trivial_neigbours |= self.start.trivial_neigbours
         for char, nodes in self.start.transitions.items():
             self.end.transitions[char] |= nodes
-        self.end.negative_match += self.start.negative_match
+        self.end.classes += self.start.classes
         self.start = self.end
         return self
+
+
+def reachable(start: Node, calls: bool = True) -> set[Node]:
+    """
+    Every node reachable from `start` by any kind of edge. With `calls` false
+    only those of the fragment that `start` begins, see `marker_targets`.
+    """
+    seen = {start}
+    front = [start]
+    while front:
+        node = front.pop()
+        targets = set(node.trivial_neigbours)
+        for nodes in node.transitions.values():
+            targets.update(nodes)
+        targets.update(target for _, target in node.classes)
+        targets.update(marker_targets(node, calls))
+        for target in targets - seen:
+            seen.add(target)
+            front.append(target)
+    return seen
@@ -0,0 +1,80 @@
+from collections.abc import Iterable
+
+from compiled import CompiledAutomaton
+
+
+class BitNFA:
+    """
+    Simulates an automaton with its set of active states as the bits of one
+    `int`. For every character class, `tables[class_id]` is the mask of the
+    states with an edge on that class and, by the bit of each such state,
+    the states it leads to, epsilon closures included. A step ORs the
+    targets of the active states that have an edge, so dead states cost
+    nothing, and the tables never hold more than the edges of the automaton.
+    """
+
+    MAX_STATES = 64
+
+    def __init__(self, automaton: CompiledAutomaton, max_states: int = MAX_STATES):
+        if automaton.markers:
+            raise ValueError(
+                "Counted repetitions and shared variables need the nfa, lazy or "
+                "dfa engine"
+            )
+        if automaton.size > max_states:
+            raise ValueError(
+                f"Automaton has more than {max_states} states, "
+                "use the nfa, lazy or dfa engine instead"
+            )
+        self.automaton = automaton
+        self.start = _mask(automaton.start_states())
+        self.accept = automaton.accept
+        self.universal = _mask(automaton.universal_states())
+        # Built for a class when it is first read
+        self.tables: list[tuple[int, dict[int, int]] | None] = [
+            None
+        ] * automaton.n_classes
+
+    def match(self, haystack: str) -> bool:
+        return bool(self.run(haystack) & self.accept)
+
+    def run(self, haystack: str, state: int | None = None) -> int:
+        """The active states after reading `haystack`, from `state` or the start."""
+        ascii_classes = self.automaton.ascii_classes
+        class_of = self.automaton.class_of
+        tables, universal = self.tables, self.universal
+        if state is None:
+            state = self.start
+        for c in haystack:
+            o = ord(c)
+            class_id = ascii_classes[o] if o < 128 else class_of(c)
+            sources, targets = tables[class_id] or self._table(class_id)
+            live = state & sources
+            state = 0
+            while live:
+                low = live & -live
+                state |= targets[low]
+                live ^= low
+            if not state or state & universal:
+                break
+        return state
+
+    def _table(self, class_id: int) -> tuple[int, dict[int, int]]:
+        auto = self.automaton
+        key = chr(class_id)
+        sources = 0
+        targets = {}
+        for s in range(auto.size):
+            i = auto.edges.find(key, auto.offsets[s], auto.offsets[s + 1])
+            if i >= 0:
+                sources |= 1 << s
+                targets[1 << s] = _mask(auto.closures[auto.targets[i]])
+        self.tables[class_id] = sources, targets
+        return sources, targets
+
+
+def _mask(states: Iterable[int]) -> int:
+    mask = 0
+    for s in states:
+        mask |= 1 << s
+    return mask
@@ -0,0 +1,98 @@
+import bisect
+from dataclasses import dataclass
+
+MAX_CODEPOINT = 0x10FFFF
+
+
+@dataclass(frozen=True, slots=True)
+class CharClass:
+    """
+    A set of characters stored as sorted, disjoint and non-adjacent inclusive
+    ranges of code points, e.g. `\\w` is four ranges instead of 63 characters.
+    """
+
+    ranges: tuple[tuple[int, int], ...]
+
+    @staticmethod
+    def from_ranges(ranges: list[tuple[int, int]]) -> "CharClass":
+        merged = []
+        for lo, hi in sorted(ranges):
+            if lo > hi:
+                continue
+            if merged and lo <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], hi))
+            else:
+                merged.append((lo, hi))
+        return CharClass(tuple(merged))
+
+    @staticmethod
+    def from_chars(chars: str) -> "CharClass":
+        return CharClass.from_ranges([(ord(c), ord(c)) for c in chars])
+
+    def negate(self) -> "CharClass":
+        result = []
+        lo = 0
+        for start, end in self.ranges:
+            if start > lo:
+                result.append((lo, start - 1))
+            lo = end + 1
+        if lo <= MAX_CODEPOINT:
+            result.append((lo, MAX_CODEPOINT))
+        return CharClass(tuple(result))
+
+    def __contains__(self, char: str) -> bool:
+        o = ord(char)
+        idx = bisect.bisect_right(self.ranges, (o, MAX_CODEPOINT)) - 1
+        return idx >= 0 and self.ranges[idx][1] >= o
+
+    def __bool__(self) -> bool:
+        return bool(self.ranges)
+
+
+ANY = CharClass(((0, MAX_CODEPOINT),))
+DIGIT = CharClass.from_ranges([(ord("0"), ord("9"))])
+WORD = CharClass.from_ranges(
+    [
+        (ord("0"), ord("9")),
+        (ord("A"), ord("Z")),
+        (ord("_"), ord("_")),
+        (ord("a"), ord("z")),
+    ]
+)
+WHITESPACE = CharClass.from_chars(" \t\r\n\f")
+
+
+def equivalence_classes(
+    classes: list[CharClass],
+) -> tuple[tuple[int, ...], tuple[int, ...], list[CharClass]]:
+    """
+    Splits all code points into classes of characters that no class in
+    `classes` can tell apart. Returns `boundaries` and `class_map`, where the
+    characters in `[boundaries[i], boundaries[i + 1])` belong to equivalence
+    class `class_map[i]`, and the equivalence classes themselves.
+    """
+    points = {0}
+    for cls in classes:
+        for lo, hi in cls.ranges:
+            points.add(lo)
+            if hi < MAX_CODEPOINT:
+                points.add(hi + 1)
+    boundaries = sorted(points)
+
+    signatures = {}
+    class_map = []
+    members = []
+    for idx, lo in enumerate(boundaries):
+        char = chr(lo)
+        signature = frozenset(i for i, cls in enumerate(classes) if char in cls)
+        if signature not in signatures:
+            signatures[signature] = len(members)
+            members.append([])
+        class_map.append(signatures[signature])
+        hi = boundaries[idx + 1] - 1 if idx + 1 < len(boundaries) else MAX_CODEPOINT
+        members[signatures[signature]].append((lo, hi))
+    return (
+        tuple(boundaries),
+        tuple(class_map),
+        [CharClass.from_ranges(ranges) for ranges in members],
+    )
@@ -0,0 +1,612 @@
+import bisect
+import struct
+from dataclasses import dataclass, field
+
+from automaton import Automaton, Call, Counter, Node, marker_targets, reachable
+from charclass import CharClass, equivalence_classes
+
+
+@dataclass(frozen=True, slots=True)
+class CompiledAutomaton:
+    """
+    Read-only form of an optimized `Automaton`.
+
+    Characters are first mapped to equivalence classes: the characters in
+    `[boundaries[i], boundaries[i + 1])` all belong to class `class_map[i]`,
+    `ascii_classes` is a shortcut for the first 128 code points and
+    `class_sets[k]` are the characters of class `k`.
+
+    Only nodes with outgoing edges and the end node become states, numbered
+    0..size-1. Edges point into `closures`, the interned epsilon closures of
+    their target nodes, so a set of active states is always closed. The edges
+    of state `s` are `edges[i]` -> `closures[targets[i]]` for
+    `offsets[s] <= i < offsets[s + 1]`, where `edges` holds `chr(class id)`
+    with every class at most once per state. Matching starts in
+    `closures[start]` and bit `s` of `accept` is set when state `s` is
+    accepting. `ends` are the states of the end nodes, in the order they were
+    given to `compile`.
+
+    `counters` are the counted repetitions, see `automaton.Counter`, as
+    `(enters, leaves, min, max, body, exit)`: the states of the two markers,
+    the bounds and the closures the body and the exit lead to. `calls` are
+    the shared variables, see `automaton.Call`, as `(returns, body, site,
+    exit, site, exit, ...)`: the state of the return marker, the closure the
+    body starts with and for each site its marker state and the closure its
+    exit leads to. Markers show up in closures but are never active
+    themselves. An active state inside counters or calls is
+    `s + size * index`, where `index` holds the counts and sites like
+    `automaton.marker_weights` does, with the counters before the calls.
+    """
+
+    size: int
+    start: int
+    accept: int
+    ends: tuple[int, ...]
+    boundaries: tuple[int, ...]
+    class_map: tuple[int, ...]
+    ascii_classes: bytes | tuple[int, ...]
+    class_sets: tuple[CharClass, ...]
+    edges: str
+    offsets: tuple[int, ...]
+    targets: tuple[int, ...]
+    closures: tuple[frozenset[int], ...]
+    counters: tuple[tuple[int, ...], ...] = ()
+    calls: tuple[tuple[int, ...], ...] = ()
+    # What each marker state does, see `_resolve`, and the closures that
+    # hold markers
+    markers: dict[int, tuple] = field(init=False, repr=False, compare=False)
+    counted_closures: frozenset[int] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        markers = {}
+        weight = 1
+        for enters, leaves, low, high, body, exit in self.counters:
+            markers[enters] = ("enters", weight, body)
+            markers[leaves] = ("leaves", weight, low, high, body, exit)
+            weight *= high
+        for returns, body, *sites in self.calls:
+            exits = tuple(sites[1::2])
+            for idx, site in enumerate(sites[::2]):
+                markers[site] = ("calls", weight, body, idx + 1)
+            markers[returns] = ("returns", weight, len(exits) + 1, exits)
+            weight *= len(exits) + 1
+        object.__setattr__(self, "markers", markers)
+        object.__setattr__(
+            self,
+            "counted_closures",
+            frozenset(
+                idx
+                for idx, closure in enumerate(self.closures)
+                if not closure.isdisjoint(markers)
+            ),
+        )
+
+    @staticmethod
+    def compile(auto: Automaton, ends: list[Node] | None = None) -> "CompiledAutomaton":
+        """
+        Expects `Node.closure` to be filled in by the optimizer. `ends`
+        replaces `auto.end` when there are several accepting nodes.
+        """
+        ends = ends or [auto.end]
+        end_nodes = set(ends)
+        nodes = sorted(reachable(auto.start), key=lambda n: n._id)
+        # Nodes that can't reach an end are dead, they never become states
+        alive = _reaching(nodes, end_nodes)
+        state_nodes = [
+            n
+            for n in nodes
+            if n in alive
+            and (
+                any(n.transitions.values())
+                or n.classes
+                or n in end_nodes
+                or n.enters is not None
+                or n.leaves is not None
+                or n.calls is not None
+                or n.returns is not None
+            )
+        ]
+        ids = {node: idx for idx, node in enumerate(state_nodes)}
+        node_closures = {
+            node: frozenset(ids[n] for n in node.closure if n in ids) for node in nodes
+        }
+        closure_ids = {}
+        closures = []
+
+        def closure_id(states: frozenset[int]) -> int:
+            if states not in closure_ids:
+                closure_ids[states] = len(closures)
+                closures.append(states)
+            return closure_ids[states]
+
+        node_edges = []
+        for node in state_nodes:
+            out = [
+                (CharClass.from_chars(char), targets)
+                for char, targets in node.transitions.items()
+                if targets
+            ]
+            out += [(cls, [target]) for cls, target in node.classes]
+            node_edges.append(out)
+        distinct = list({cls: None for out in node_edges for cls, _ in out})
+        boundaries, class_map, class_sets = equivalence_classes(distinct)
+
+        start = closure_id(node_closures[auto.start])
+        edges, targets, offsets = [], [], [0]
+        for out in node_edges:
+            by_class = {}
+            for cls, nodes_ in out:
+                states = frozenset().union(*(node_closures[n] for n in nodes_))
+                if not states:
+                    continue
+                for lo, hi in cls.ranges:
+                    first = bisect.bisect_left(boundaries, lo)
+                    last = bisect.bisect_right(boundaries, hi)
+                    for idx in range(first, last):
+                        by_class.setdefault(class_map[idx], set()).update(states)
+            for class_id in sorted(by_class):
+                edges.append(chr(class_id))
+                targets.append(closure_id(frozenset(by_class[class_id])))
+            offsets.append(len(edges))
+
+        leaves_at = {n.leaves: n for n in state_nodes if n.leaves is not None}
+        counters = tuple(
+            (
+                ids[node],
+                ids[leaves_at[node.enters]],
+                node.enters.min,
+                node.enters.max,
+                closure_id(node_closures[node.enters.body]),
+                closure_id(node_closures[node.enters.exit]),
+            )
+            for node in state_nodes
+            if node.enters is not None
+        )
+        # Sites that can't reach an end are left out, the others are numbered
+        # again in the order they were created
+        sites = {}
+        for node in state_nodes:
+            if node.calls is not None:
+                sites.setdefault(node.calls[0], []).append(node)
+        calls = []
+        for node in state_nodes:
+            if node.returns is not None:
+                call = node.returns
+                entry = [ids[node], closure_id(node_closures[call.body])]
+                for site in sorted(sites.get(call, ()), key=lambda n: n.calls[1]):
+                    exit = call.exits[site.calls[1]]
+                    entry += [ids[site], closure_id(node_closures[exit])]
+                calls.append(tuple(entry))
+
+        return CompiledAutomaton(
+            size=len(state_nodes),
+            start=start,
+            accept=sum(1 << ids[end] for end in end_nodes),
+            ends=tuple(ids[end] for end in ends),
+            boundaries=boundaries,
+            class_map=class_map,
+            ascii_classes=_ascii_classes(boundaries, class_map, len(class_sets)),
+            class_sets=tuple(class_sets),
+            edges="".join(edges),
+            offsets=tuple(offsets),
+            targets=tuple(targets),
+            closures=tuple(closures),
+            counters=counters,
+            calls=tuple(calls),
+        )
+
+    def unanchored(self, start: bool, end: bool) -> "CompiledAutomaton":
+        """
+        The automaton of `.*X.*` from the one of `X`, with the `.*` only on
+        the chosen sides. A new state loops on every character in front of
+        the start states, and accepting states loop on every character, so
+        nothing has to be parsed or compiled again.
+        """
+        closure_ids = {states: idx for idx, states in enumerate(self.closures)}
+        closures = list(self.closures)
+
+        def closure_id(states: frozenset[int]) -> int:
+            if states not in closure_ids:
+                closure_ids[states] = len(closures)
+                closures.append(states)
+            return closure_ids[states]
+
+        everything = range(self.n_classes)
+        by_state = []
+        for s in range(self.size):
+            out = {
+                ord(self.edges[i]): self.closures[self.targets[i]]
+                for i in range(self.offsets[s], self.offsets[s + 1])
+            }
+            if end and self.accept >> s & 1:
+                out = {k: out.get(k, frozenset()) | {s} for k in everything}
+            by_state.append(out)
+        start_id = self.start
+        if start:
+            loop = self.size
+            start_states = self.closures[self.start] | {loop}
+            by_state.append({k: start_states for k in everything})
+            start_id = closure_id(start_states)
+
+        edges, targets, offsets = [], [], [0]
+        for out in by_state:
+            for class_id in sorted(out):
+                edges.append(chr(class_id))
+                targets.append(closure_id(out[class_id]))
+            offsets.append(len(edges))
+        return CompiledAutomaton(
+            size=len(by_state),
+            start=start_id,
+            accept=self.accept,
+            ends=self.ends,
+            boundaries=self.boundaries,
+            class_map=self.class_map,
+            ascii_classes=self.ascii_classes,
+            class_sets=self.class_sets,
+            edges="".join(edges),
+            offsets=tuple(offsets),
+            targets=tuple(targets),
+            closures=tuple(closures),
+            counters=self.counters,
+            calls=self.calls,
+        )
+
+    def to_bytes(self) -> bytes:
+        """
+        A compact binary form for `from_buffer`: little-endian arrays of
+        unsigned 32-bit integers, each prefixed by its length.
+        """
+        accepting = [s for s in range(self.size) if self.accept >> s & 1]
+        parts = [
+            _pack_ints([self.size, self.start]),
+            _pack_ints(accepting),
+            _pack_ints(self.ends),
+            _pack_ints(self.boundaries),
+            _pack_ints(self.class_map),
+            _pack_ints([len(self.class_sets)]),
+        ]
+        parts += [
+            _pack_ints([bound for r in cls.ranges for bound in r])
+            for cls in self.class_sets
+        ]
+        parts += [
+            _pack_ints([ord(c) for c in self.edges]),
+            _pack_ints(self.offsets),
+            _pack_ints(self.targets),
+            _pack_ints([len(closure) for closure in self.closures]),
+            _pack_ints([s for closure in self.closures for s in sorted(closure)]),
+            _pack_ints([value for counter in self.counters for value in counter]),
+            _pack_ints([len(self.calls)]),
+        ]
+        parts += [_pack_ints(call) for call in self.calls]
+        return b"".join(parts)
+
+    @staticmethod
+    def from_buffer(buffer, offset: int = 0) -> tuple["CompiledAutomaton", int]:
+        """
+        Reads what `to_bytes` wrote at `offset` of any buffer, e.g. an `mmap`.
+        Returns the automaton and the offset right after it.
+        """
+        (size, start), offset = _unpack_ints(buffer, offset)
+        accepting, offset = _unpack_ints(buffer, offset)
+        ends, offset = _unpack_ints(buffer, offset)
+        boundaries, offset = _unpack_ints(buffer, offset)
+        class_map, offset = _unpack_ints(buffer, offset)
+        (n_classes,), offset = _unpack_ints(buffer, offset)
+        class_sets = []
+        for _ in range(n_classes):
+            bounds, offset = _unpack_ints(buffer, offset)
+            class_sets.append(CharClass(tuple(zip(bounds[::2], bounds[1::2]))))
+        edges, offset = _unpack_ints(buffer, offset)
+        offsets, offset = _unpack_ints(buffer, offset)
+        targets, offset = _unpack_ints(buffer, offset)
+        lengths, offset = _unpack_ints(buffer, offset)
+        flat, offset = _unpack_ints(buffer, offset)
+        closures = []
+        pos = 0
+        for length in lengths:
+            closures.append(frozenset(flat[pos : pos + length]))
+            pos += length
+        counters, offset = _unpack_ints(buffer, offset)
+        (n_calls,), offset = _unpack_ints(buffer, offset)
+        calls = []
+        for _ in range(n_calls):
+            call, offset = _unpack_ints(buffer, offset)
+            calls.append(call)
+        auto = CompiledAutomaton(
+            size=size,
+            start=start,
+            accept=sum(1 << s for s in accepting),
+            ends=ends,
+            boundaries=boundaries,
+            class_map=class_map,
+            ascii_classes=_ascii_classes(boundaries, class_map, n_classes),
+            class_sets=tuple(class_sets),
+            edges="".join(map(chr, edges)),
+            offsets=offsets,
+            targets=targets,
+            closures=tuple(closures),
+            counters=tuple(counters[i : i + 6] for i in range(0, len(counters), 6)),
+            calls=tuple(calls),
+        )
+        return auto, offset
+
+    @property
+    def n_classes(self) -> int:
+        return len(self.class_sets)
+
+    def class_of(self, c: str) -> int:
+        o = ord(c)
+        if o < 128:
+            return self.ascii_classes[o]
+        return self.class_map[bisect.bisect_right(self.boundaries, o) - 1]
+
+    def start_states(self) -> frozenset[int]:
+        if self.markers:
+            return frozenset(self._resolve(self.start, 0))
+        return self.closures[self.start]
+
+    def step(self, states: set[int], c: str) -> set[int]:
+        return self.step_class(states, self.class_of(c))
+
+    def step_class(self, states: set[int], class_id: int) -> set[int]:
+        key = chr(class_id)
+        if self.markers:
+            return self._step_counted(states, key)
+        edges, offsets = self.edges, self.offsets
+        targets, closures = self.targets, self.closures
+        result = set()
+        for s in states:
+            i = edges.find(key, offsets[s], offsets[s + 1])
+            if i >= 0:
+                result |= closures[targets[i]]
+        return result
+
+    def accepts(self, states: set[int]) -> bool:
+        accept = self.accept
+        return any(accept >> s & 1 for s in states)
+
+    def universal_states(self) -> frozenset[int]:
+        """
+        Accepting states that can stay accepting whatever comes next, e.g. the
+        end of `a.*`. Once one of them is active the input is accepted.
+        """
+        universal = {s for s in range(self.size) if self.accept >> s & 1}
+        changed = True
+        while changed:
+            changed = False
+            for s in list(universal):
+                first, last = self.offsets[s], self.offsets[s + 1]
+                # A missing class would kill the state
+                if last - first < self.n_classes or any(
+                    universal.isdisjoint(self.closures[self.targets[i]])
+                    for i in range(first, last)
+                ):
+                    universal.discard(s)
+                    changed = True
+        return frozenset(universal)
+
+    def match(self, haystack: str, stop: frozenset[int] = frozenset()) -> bool:
+        return self.accepts(self.run(haystack, stop=stop))
+
+    def run(
+        self,
+        haystack: str,
+        states: set[int] | None = None,
+        stop: frozenset[int] = frozenset(),
+    ) -> set[int]:
+        """
+        The states that are active after reading `haystack`, starting from
+        `states` or the start states. Reading ends early once one of `stop`,
+        e.g. the `universal_states`, is active.
+        """
+        # `step` inlined, this is the hot loop of the default engine
+        ascii_classes, class_map, boundaries = (
+            self.ascii_classes,
+            self.class_map,
+            self.boundaries,
+        )
+        edges, offsets = self.edges, self.offsets
+        targets, closures = self.targets, self.closures
+        bisect_right = bisect.bisect_right
+        if states is None:
+            states = self.start_states()
+        if self.markers:
+            for c in haystack:
+                states = self._step_counted(states, chr(self.class_of(c)))
+                if not states or stop and not stop.isdisjoint(states):
+                    break
+            return states
+        for c in haystack:
+            o = ord(c)
+            key = chr(
+                ascii_classes[o]
+                if o < 128
+                else class_map[bisect_right(boundaries, o) - 1]
+            )
+            new_states = set()
+            for s in states:
+                i = edges.find(key, offsets[s], offsets[s + 1])
+                if i >= 0:
+                    new_states |= closures[targets[i]]
+            if not new_states:
+                return new_states
+            states = new_states
+            if stop and not stop.isdisjoint(states):
+                break
+        return states
+
+    def _step_counted(self, states: set[int], key: str) -> set[int]:
+        """`step_class` for automata with counters or calls."""
+        edges, offsets, targets, size = (
+            self.edges,
+            self.offsets,
+            self.targets,
+            self.size,
+        )
+        result = set()
+        for state in states:
+            index, s = divmod(state, size)
+            i = edges.find(key, offsets[s], offsets[s + 1])
+            if i >= 0:
+                result |= self._resolve(targets[i], index)
+        return result
+
+    def _resolve(self, closure: int, index: int) -> set[int]:
+        """
+        The active states after entering `closures[closure]` with the counts
+        and sites in `index`, with every marker replaced by what it leads to.
+        """
+        size = self.size
+        if closure not in self.counted_closures:
+            if not index:
+                return set(self.closures[closure])
+            return {s + size * index for s in self.closures[closure]}
+        markers = self.markers
+        result = set()
+        seen = set()
+        work = [(closure, index)]
+        while work:
+            item = work.pop()
+            if item in seen:
+                continue
+            seen.add(item)
+            closure, index = item
+            for s in self.closures[closure]:
+                marker = markers.get(s)
+                if marker is None:
+                    result.add(s + size * index)
+                    continue
+                kind, weight, *args = marker
+                if kind == "enters":
+                    work.append((args[0], index))
+                elif kind == "leaves":
+                    low, high, body, exit = args
+                    count = index // weight % high
+                    if count + 1 < high:
+                        work.append((body, index + weight))
+                    if count + 1 >= low:
+                        work.append((exit, index - count * weight))
+                elif kind == "calls":
+                    body, site = args
+                    work.append((body, index + site * weight))
+                else:
+                    radix, exits = args
+                    site = index // weight % radix
+                    if site:
+                        work.append((exits[site - 1], index - site * weight))
+        return result
+
+    def uncounted(self) -> "CompiledAutomaton":
+        """
+        This automaton with every A{m,n} turned into A+, which accepts at
+        least the same strings, e.g. for analyses that can't count. Calls
+        lead from every site to the body and from the body to every exit,
+        which accepts more strings too. Marker states stay, without edges and
+        out of every closure.
+        """
+        if not self.markers:
+            return self
+        expanded = []
+        for closure in range(len(self.closures)):
+            states = set()
+            seen = set()
+            work = [closure]
+            while work:
+                current = work.pop()
+                if current in seen:
+                    continue
+                seen.add(current)
+                for s in self.closures[current]:
+                    marker = self.markers.get(s)
+                    if marker is None:
+                        states.add(s)
+                    elif marker[0] == "leaves":
+                        work += marker[4:6]
+                    elif marker[0] == "returns":
+                        work += marker[3]
+                    else:
+                        work.append(marker[2])
+            expanded.append(frozenset(states))
+        return CompiledAutomaton(
+            size=self.size,
+            start=self.start,
+            accept=self.accept,
+            ends=self.ends,
+            boundaries=self.boundaries,
+            class_map=self.class_map,
+            ascii_classes=self.ascii_classes,
+            class_sets=self.class_sets,
+            edges=self.edges,
+            offsets=self.offsets,
+            targets=self.targets,
+            closures=tuple(expanded),
+        )
+
+    def to_automaton(self) -> Automaton:
+        """Rebuilds a mutable graph, e.g. to use this pattern as a variable."""
+        nodes = [Node() for _ in range(self.size)]
+        closure_nodes = [Node() for _ in self.closures]
+        for enters, leaves, low, high, body, exit in self.counters:
+            counter = Counter(low, high, closure_nodes[body], closure_nodes[exit])
+            nodes[enters].enters = nodes[leaves].leaves = counter
+        for returns, body, *sites in self.calls:
+            exits = [closure_nodes[exit] for exit in sites[1::2]]
+            call = Call(closure_nodes[body], exits)
+            nodes[returns].returns = call
+            for idx, site in enumerate(sites[::2]):
+                nodes[site].calls = call, idx
+        for closure, closure_node in zip(self.closures, closure_nodes):
+            for s in closure:
+                closure_node.connect_trivial(nodes[s])
+        for s, node in enumerate(nodes):
+            by_target = {}
+            for i in range(self.offsets[s], self.offsets[s + 1]):
+                by_target.setdefault(self.targets[i], []).extend(
+                    self.class_sets[ord(self.edges[i])].ranges
+                )
+            for target, ranges in by_target.items():
+                node.connect_class(CharClass.from_ranges(ranges), closure_nodes[target])
+        return Automaton(closure_nodes[self.start], nodes[self.ends[0]])
+
+
+def _reaching(nodes: list[Node], targets: set[Node]) -> set[Node]:
+    """The nodes with a path of any kind of edges into `targets`."""
+    sources = {node: [] for node in nodes}
+    for node in nodes:
+        out = set(node.trivial_neigbours)
+        for targets_ in node.transitions.values():
+            out.update(targets_)
+        out.update(target for _, target in node.classes)
+        out.update(marker_targets(node))
+        for target in out:
+            if target in sources:
+                sources[target].append(node)
+    found = {node for node in targets if node in sources}
+    front = list(found)
+    while front:
+        for source in sources[front.pop()]:
+            if source not in found:
+                found.add(source)
+                front.append(source)
+    return found
+
+
+def _ascii_classes(
+    boundaries: tuple[int, ...], class_map: tuple[int, ...], n_classes: int
+) -> bytes | tuple[int, ...]:
+    classes = tuple(
+        class_map[bisect.bisect_right(boundaries, o) - 1] for o in range(128)
+    )
+    return bytes(classes) if n_classes <= 256 else classes
+
+
+def _pack_ints(values: list[int]) -> bytes:
+    return struct.pack(f"<I{len(values)}I", len(values), *values)
+
+
+def _unpack_ints(buffer, offset: int) -> tuple[tuple[int, ...], int]:
+    (length,) = struct.unpack_from("<I", buffer, offset)
+    offset += 4
+    values = struct.unpack_from(f"<{length}I", buffer, offset)
+    return values, offset + 4 * length
@@ -0,0 +1,303 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+from compiled import CompiledAutomaton
+
+
+@dataclass(eq=False)
+class DState:
+    """A set of NFA states seen as one DFA state."""
+
+    states: frozenset[int]
+    accepting: bool
+    # By ASCII character or else by character class, so it can't grow with
+    # the characters of the input
+    next: dict[str | int, "DState"] = field(default_factory=dict)
+    # The states and keys whose `next` leads here, to unlink an evicted state
+    sources: set[tuple["DState", str | int]] = field(default_factory=set)
+    cached: bool = True
+    # More input can't change `accepting`: no state is left or one of them
+    # is universal
+    final: bool = False
+
+
+class LazyDFA:
+    """
+    Determinizes an automaton while matching. Every reachable set of states is
+    interned as a DState and its transitions are remembered per ASCII
+    character or per character class for the others, so a state set that was
+    already seen costs one or two dict lookups per character.
+
+    At most `max_states` states are kept. When the cache is full it is either
+    emptied completely ("flush") or the least recently used state is dropped
+    ("lru"). No transition leads to an evicted state anymore, so it is freed
+    and simply recomputed when it is needed again.
+    """
+
+    MAX_STATES = 1024
+    EVICTION_POLICIES = ("flush", "lru")
+
+    def __init__(
+        self,
+        automaton: CompiledAutomaton,
+        max_states: int = MAX_STATES,
+        eviction: str = "flush",
+    ):
+        if eviction not in self.EVICTION_POLICIES:
+            raise ValueError(f"Unknown eviction policy '{eviction}'")
+        if max_states < 2:
+            raise ValueError("The DFA cache must hold at least 2 states")
+        self.automaton = automaton
+        self.max_states = max_states
+        self.eviction = eviction
+        self.evictions = 0
+        self.cache: OrderedDict[frozenset[int], DState] = OrderedDict()
+        self.universal = automaton.universal_states()
+        self.start = self._intern(automaton.start_states())
+
+    def match(self, haystack: str) -> bool:
+        return self.run(haystack).accepting
+
+    def run(self, haystack: str, state: DState | None = None) -> DState:
+        """The state after reading `haystack`, starting from `state` or the start."""
+        if state is None:
+            state = self.start
+        elif not state.cached:
+            # Kept by the caller past its eviction
+            state = self._intern(state.states)
+        lru = self.eviction == "lru"
+        class_of = self.automaton.class_of
+        for c in haystack:
+            next_state = state.next.get(c)
+            if next_state is None:
+                if c < "\x80":
+                    next_state = self._step(state, c, class_of(c))
+                else:
+                    # Other characters are looked up by class, one entry per
+                    # character could grow without bound
+                    class_id = class_of(c)
+                    next_state = state.next.get(class_id)
+                    if next_state is None:
+                        next_state = self._step(state, class_id, class_id)
+            if lru and next_state.cached:
+                self.cache.move_to_end(next_state.states)
+            state = next_state
+            if state.final:
+                break
+        return state
+
+    def _step(self, state: DState, key: str | int, class_id: int) -> DState:
+        next_state = self._intern(self.automaton.step_class(state.states, class_id))
+        # Interning can evict `state`, which then must not lead anywhere
+        if state.cached:
+            state.next[key] = next_state
+            if self.eviction == "lru":
+                next_state.sources.add((state, key))
+        return next_state
+
+    def _intern(self, states: set[int]) -> DState:
+        key = frozenset(states)
+        state = self.cache.get(key)
+        if state is not None:
+            if self.eviction == "lru":
+                self.cache.move_to_end(key)
+            return state
+        if len(self.cache) >= self.max_states:
+            self._evict()
+        state = DState(
+            key,
+            self.automaton.accepts(key),
+            final=not key or not self.universal.isdisjoint(key),
+        )
+        self.cache[key] = state
+        return state
+
+    def _evict(self):
+        self.evictions += 1
+        if self.eviction == "flush":
+            for state in self.cache.values():
+                state.next.clear()
+                state.cached = False
+            self.cache.clear()
+            # The start state is needed by every match, keep it around
+            self.start.cached = True
+            self.cache[self.start.states] = self.start
+            return
+        key, state = self.cache.popitem(last=False)
+        if state is self.start:
+            self.cache[key] = state
+            key, state = self.cache.popitem(last=False)
+        for source, char in state.sources:
+            del source.next[char]
+        for char, target in state.next.items():
+            target.sources.discard((state, char))
+        state.sources.clear()
+        state.next.clear()
+        state.cached = False
+
+
+class DFA:
+    """
+    Determinizes an automaton ahead of time with the subset construction and
+    minimizes the result with Hopcroft's algorithm, so matching is a table
+    walk. The alphabet are the character classes of the compiled automaton:
+    `table[state * n_classes + class_id]` is the next state.
+    """
+
+    MAX_STATES = 10000
+
+    def __init__(self, automaton: CompiledAutomaton, max_states: int = MAX_STATES):
+        self.automaton = automaton
+        self.n_classes = automaton.n_classes
+        transitions, accepting = self._determinize(automaton, max_states)
+        n = self.n_classes
+        self.start, self.table, self.accepting = self._absorbing_last(
+            n, *self._minimize(n, transitions, accepting)
+        )
+        self.state_count = len(self.accepting)
+        # States that only lead to themselves, numbered from `stop` on. After
+        # minimization there is at most one that accepts and one that doesn't.
+        self.stop = next(
+            (
+                s
+                for s in range(self.state_count)
+                if all(t == s for t in self.table[s * n : (s + 1) * n])
+            ),
+            self.state_count,
+        )
+        dead = [s for s in range(self.stop, self.state_count) if not self.accepting[s]]
+        self.dead = dead[0] if dead else -1
+        self.universal = self._universal(self.table, self.accepting, n)
+
+    def match(self, haystack: str) -> bool:
+        return self.accepting[self.run(haystack)]
+
+    def run(self, haystack: str, state: int | None = None) -> int:
+        """The state after reading `haystack`, starting from `state` or the start."""
+        class_of = self.automaton.class_of
+        if state is None:
+            state = self.start
+        table, n, stop = self.table, self.n_classes, self.stop
+        for c in haystack:
+            state = table[state * n + class_of(c)]
+            if state >= stop:
+                break
+        return state
+
+    @staticmethod
+    def _absorbing_last(
+        n: int, start: int, table: tuple[int, ...], accepting: tuple[bool, ...]
+    ) -> tuple[int, tuple[int, ...], tuple[bool, ...]]:
+        """
+        Renumbers the states so the ones that only lead to themselves come
+        last, then `run` can stop at them with a single comparison.
+        """
+        count = len(accepting)
+        absorbing = [
+            all(t == s for t in table[s * n : (s + 1) * n]) for s in range(count)
+        ]
+        order = sorted(range(count), key=lambda s: absorbing[s])
+        new_id = [0] * count
+        for new, old in enumerate(order):
+            new_id[old] = new
+        return (
+            new_id[start],
+            tuple(new_id[t] for old in order for t in table[old * n : (old + 1) * n]),
+            tuple(accepting[old] for old in order),
+        )
+
+    @staticmethod
+    def _universal(
+        table: tuple[int, ...], accepting: tuple[bool, ...], n: int
+    ) -> tuple[bool, ...]:
+        """The states from which every input is accepted."""
+        universal = list(accepting)
+        changed = True
+        while changed:
+            changed = False
+            for s, is_universal in enumerate(universal):
+                if is_universal and not all(
+                    universal[t] for t in table[s * n : (s + 1) * n]
+                ):
+                    universal[s] = False
+                    changed = True
+        return tuple(universal)
+
+    @staticmethod
+    def _determinize(
+        automaton: CompiledAutomaton, max_states: int
+    ) -> tuple[list[list[int]], list[bool]]:
+        """Subset construction, one column per character class."""
+        start = automaton.start_states()
+        states = [start]
+        ids = {start: 0}
+        transitions = []
+        idx = 0
+        while idx < len(states):
+            row = []
+            for class_id in range(automaton.n_classes):
+                target = frozenset(automaton.step_class(states[idx], class_id))
+                if target not in ids:
+                    if len(states) >= max_states:
+                        raise ValueError(
+                            f"DFA has more than {max_states} states, "
+                            "use the lazy or nfa engine instead"
+                        )
+                    ids[target] = len(states)
+                    states.append(target)
+                row.append(ids[target])
+            transitions.append(row)
+            idx += 1
+        accepting = [automaton.accepts(state) for state in states]
+        return transitions, accepting
+
+    @staticmethod
+    def _minimize(
+        n_symbols: int, transitions: list[list[int]], accepting: list[bool]
+    ) -> tuple[int, tuple[int, ...], tuple[bool, ...]]:
+        """Hopcroft's partition refinement. Returns the start state and tables."""
+        n = len(transitions)
+        inverse = [[[] for _ in range(n)] for _ in range(n_symbols)]
+        for state, row in enumerate(transitions):
+            for symbol, target in enumerate(row):
+                inverse[symbol][target].append(state)
+
+        blocks = [
+            b
+            for b in (
+                {s for s in range(n) if accepting[s]},
+                {s for s in range(n) if not accepting[s]},
+            )
+            if b
+        ]
+        block_of = [0] * n
+        for b, block in enumerate(blocks):
+            for s in block:
+                block_of[s] = b
+        work = set(range(len(blocks)))
+        while work:
+            splitter = set(blocks[work.pop()])
+            for symbol in range(n_symbols):
+                touched = {}
+                for target in splitter:
+                    for s in inverse[symbol][target]:
+                        touched.setdefault(block_of[s], set()).add(s)
+                for b, inside in touched.items():
+                    if len(inside) == len(blocks[b]):
+                        continue
+                    blocks[b] -= inside
+                    new = len(blocks)
+                    blocks.append(inside)
+                    for s in inside:
+                        block_of[s] = new
+                    if b in work or len(inside) <= len(blocks[b]):
+                        work.add(new)
+                    else:
+                        work.add(b)
+
+        table, final = [], []
+        for block in blocks:
+            representative = next(iter(block))
+            table.extend(block_of[t] for t in transitions[representative])
+            final.append(accepting[representative])
+        return block_of[0], tuple(table), tuple(final)
@@ -1,33 +1,152 @@
-from automaton import Automaton, Node
+from automaton import Automaton, Call, Counter, Node, reachable
 
 
 def optimize_automaton(auto: Automaton) -> Automaton:
-    auto.start = optimize_node(auto.start)
+    compute_closures(auto)
     return auto
 
 
-def optimize_node(node: Node) -> Node:
-    if node.transitions or node.negative_match:
-        return node
-    edges = list(find_edges(node, set()))
-    if len(edges) == 1:
-        return edges[0]
-    new_node = Node()
-    for edge in edges:
-        for char, nodes in edge.transitions.items():
-            new_node.transitions[char].update(nodes)
-        new_node.trivial_neigbours.update(edge.trivial_neigbours)
-        new_node.negative_match.extend(edge.negative_match)
-    return new_node
-
-
-def find_edges(node: Node, visited: set[Node]) -> set[Node]:
-    if node in visited:
-        return set()
-    visited.add(node)
-    if node.transitions or node.negative_match:
-        return {node}
-    result = set()
-    for n in node.trivial_neigbours:
-        result.update(find_edges(n, visited))
-    return result
+def compute_closures(auto: Automaton) -> Automaton:
+    """
+    Stores the epsilon closure of every reachable node in `Node.closure`, so
+    matching never has to walk trivial edges.
+
+    Trivial edges can form cycles (e.g. `(a|)*`), so the closures are built
+    per strongly connected component, in reverse topological order, reusing
+    the closures of the components below.
+    """
+    for component in trivial_components(reachable(auto.start)):
+        closure = set(component)
+        for node in component:
+            for n in node.trivial_neigbours:
+                if n not in closure:
+                    closure.update(n.closure)
+        closure = frozenset(closure)
+        for node in component:
+            node.closure = closure
+    return auto
+
+
+def position_automaton(auto: Automaton) -> Automaton:
+    """
+    The follow-set (Glushkov) form of `auto`: one node per consuming edge,
+    entered by reading that edge's characters, plus a new start and end node.
+    Node `p` gets an edge to `q` when `q`'s edge leaves a node in the epsilon
+    closure of `p`'s target. The only trivial edges left lead into the end
+    node, from the positions after which `auto` can accept, and into the
+    markers of counted repetitions and shared variables. Their counters and
+    calls start and exit at new nodes that lead to the positions of the old
+    ones.
+    """
+    compute_closures(auto)
+    start, end = Node(), Node()
+    # Edges with the same label and target are the same position
+    positions = {}
+    out = {}
+    for node in reachable(auto.start):
+        edges = [
+            (char, None, target)
+            for char, nodes in node.transitions.items()
+            for target in nodes
+        ]
+        edges += [(None, cls, target) for cls, target in node.classes]
+        for edge in edges:
+            positions.setdefault(edge, Node())
+        out[node] = [
+            (char, cls, positions[char, cls, target]) for char, cls, target in edges
+        ]
+
+    counters = {}
+    markers = {}
+    for node in out:
+        counter = node.enters or node.leaves
+        if counter is None:
+            continue
+        if counter not in counters:
+            counters[counter] = Counter(counter.min, counter.max, Node(), Node())
+        if node.enters is not None:
+            markers[node] = Node(enters=counters[counter])
+        else:
+            markers[node] = Node(leaves=counters[counter])
+
+    calls = {}
+    for node in out:
+        call = node.returns or (node.calls[0] if node.calls is not None else None)
+        if call is None:
+            continue
+        if call not in calls:
+            calls[call] = Call(Node(), [Node() for _ in call.exits])
+        if node.returns is not None:
+            markers[node] = Node(returns=calls[call])
+        else:
+            markers[node] = Node(calls=(calls[call], node.calls[1]))
+
+    def connect(source: Node, closure: frozenset[Node]):
+        edges = dict.fromkeys(e for node in closure for e in out[node])
+        for char, cls, position in edges:
+            if cls is None:
+                source.connect_literal(char, position)
+            else:
+                source.connect_class(cls, position)
+        if auto.end in closure:
+            source.connect_trivial(end)
+        for node in closure:
+            if node in markers:
+                source.connect_trivial(markers[node])
+
+    connect(start, auto.start.closure)
+    for (_, _, target), position in positions.items():
+        connect(position, target.closure)
+    for old, new in counters.items():
+        connect(new.body, old.body.closure)
+        connect(new.exit, old.exit.closure)
+    for old, new in calls.items():
+        connect(new.body, old.body.closure)
+        for old_exit, new_exit in zip(old.exits, new.exits):
+            connect(new_exit, old_exit.closure)
+    return Automaton(start, end)
+
+
+def trivial_components(nodes: set[Node]) -> list[list[Node]]:
+    """
+    Tarjan's algorithm over the trivial edges. Components come out in reverse
+    topological order: every component is listed after the ones it points to.
+    """
+    index = {}
+    low = {}
+    stack = []
+    on_stack = set()
+    components = []
+    for root in nodes:
+        if root in index:
+            continue
+        work = [(root, iter(root.trivial_neigbours))]
+        index[root] = low[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            node, neighbours = work[-1]
+            for n in neighbours:
+                if n not in index:
+                    index[n] = low[n] = len(index)
+                    stack.append(n)
+                    on_stack.add(n)
+                    work.append((n, iter(n.trivial_neigbours)))
+                    break
+                if n in on_stack:
+                    low[node] = min(low[node], index[n])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] == index[node]:
+                    component = []
+                    while True:
+                        n = stack.pop()
+                        on_stack.discard(n)
+                        component.append(n)
+                        if n == node:
+                            break
+                    components.append(component)
+    return components
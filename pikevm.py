@@ -0,0 +1,143 @@
+from automaton import Automaton, marker_weights, reachable
+
+
+class PikeVM:
+    """
+    Finds the capture groups of a match by running all threads of the
+    epsilon automaton in lockstep, each with its own capture slots. Threads
+    are kept in priority order and only the first thread to reach a node
+    survives, so every character costs at most one step per node and the
+    time stays linear in the haystack, whatever the pattern.
+
+    Nodes with a `tag` record the current position in slot `tag` when a
+    thread passes them: slots `2 * (k - 1)` and `2 * k - 1` are where group
+    `k` starts and ends. Epsilon edges are taken in the order their targets
+    were created, which makes the parse greedy and prefers the left branch
+    of a choice, like backtracking engines do. A thread at the node that
+    leaves a counted repetition tries another pass before it exits, and
+    threads inside counters or shared variables are told apart by their
+    counts and sites like the states of `compiled.CompiledAutomaton`.
+    """
+
+    def __init__(self, auto: Automaton, groups: int):
+        self.groups = groups
+        nodes = sorted(reachable(auto.start) | {auto.end}, key=lambda n: n._id)
+        ids = {node: idx for idx, node in enumerate(nodes)}
+        self.start = ids[auto.start]
+        self.accept = ids[auto.end]
+        self.tags = [node.tag for node in nodes]
+        self.epsilons = [
+            [ids[n] for n in sorted(node.trivial_neigbours, key=lambda n: n._id)]
+            for node in nodes
+        ]
+        self.literals = [
+            {
+                char: [ids[n] for n in sorted(targets, key=lambda n: n._id)]
+                for char, targets in node.transitions.items()
+                if targets
+            }
+            for node in nodes
+        ]
+        self.classes = [[(cls, ids[n]) for cls, n in node.classes] for node in nodes]
+        self.size = len(nodes)
+        weights = marker_weights(nodes)
+        self.markers = {}
+        for node in nodes:
+            if node.enters is not None:
+                counter = node.enters
+                marker = ("enters", weights[counter], ids[counter.body])
+            elif node.leaves is not None:
+                counter = node.leaves
+                marker = (
+                    "leaves",
+                    weights[counter],
+                    counter.min,
+                    counter.max,
+                    ids[counter.body],
+                    ids[counter.exit],
+                )
+            elif node.calls is not None:
+                call, site = node.calls
+                marker = ("calls", weights[call], ids[call.body], site + 1)
+            elif node.returns is not None:
+                call = node.returns
+                exits = [ids[exit] for exit in call.exits]
+                marker = ("returns", weights[call], len(exits) + 1, exits)
+            else:
+                continue
+            self.markers[ids[node]] = marker
+
+    def full_match(
+        self, haystack: str, start: int = 0, end: int | None = None
+    ) -> tuple[int | None, ...] | None:
+        """
+        The capture slots of the highest priority parse of `haystack[start:end]`
+        as a whole, `None` if it doesn't match. Positions are in `haystack`.
+        """
+        if end is None:
+            end = len(haystack)
+        threads = self._follow({}, self.start, (None,) * (2 * self.groups), start)
+        for pos in range(start, end):
+            c = haystack[pos]
+            next_threads = {}
+            for thread, slots in threads.items():
+                index, node = divmod(thread, self.size)
+                offset = self.size * index
+                for target in self.literals[node].get(c, ()):
+                    self._follow(next_threads, target + offset, slots, pos + 1)
+                for cls, target in self.classes[node]:
+                    if c in cls:
+                        self._follow(next_threads, target + offset, slots, pos + 1)
+            if not next_threads:
+                return None
+            threads = next_threads
+        return threads.get(self.accept)
+
+    def _follow(
+        self, threads: dict, thread: int, slots: tuple[int | None, ...], pos: int
+    ) -> dict:
+        """Adds `thread` and what its epsilon edges reach, depth first."""
+        stack = [(thread, slots)]
+        while stack:
+            thread, slots = stack.pop()
+            if thread in threads:
+                continue
+            index, node = divmod(thread, self.size)
+            tag = self.tags[node]
+            if tag is not None:
+                slots = slots[:tag] + (pos,) + slots[tag + 1 :]
+            threads[thread] = slots
+            marker = self.markers.get(node)
+            if marker is None:
+                offset = self.size * index
+                targets = [n + offset for n in self.epsilons[node]]
+            else:
+                targets = self._counted(marker, index)
+            stack.extend((t, slots) for t in reversed(targets))
+        return threads
+
+    def _counted(self, marker: tuple[int, ...], index: int) -> list[int]:
+        """
+        Where a marker leads with the counts and sites in `index`, in priority
+        order.
+        """
+        kind, weight, *args = marker
+        if kind == "enters":
+            return [args[0] + self.size * index]
+        if kind == "calls":
+            body, site = args
+            return [body + self.size * (index + site * weight)]
+        if kind == "returns":
+            radix, exits = args
+            site = index // weight % radix
+            if not site:
+                return []
+            return [exits[site - 1] + self.size * (index - site * weight)]
+        low, high, body, exit = args
+        targets = []
+        count = index // weight % high
+        if count + 1 < high:
+            targets.append(body + self.size * (index + weight))
+        if count + 1 >= low:
+            targets.append(exit + self.size * (index - count * weight))
+        return targets
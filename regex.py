@@ -1,66 +1,880 @@
+import argparse
+import codecs
+import itertools
+import mmap
+import struct
+import sys
+from collections import OrderedDict, deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import NamedTuple
+
 import reparser
+from analysis import (
+    Prefilter,
+    first_chars,
+    length_bounds,
+    literal_string,
+    single_class,
+)
+from automaton import Automaton
+from charclass import CharClass
+from compiled import CompiledAutomaton
+from bitnfa import BitNFA
+from dfa import DFA, LazyDFA
 from optimizer import optimize_automaton
+from pikevm import PikeVM
+from vectorized import BatchDFA
+
+# Larger first character sets are not worth a `str.find` per character
+_MAX_FIRST_CHARS = 4
+
+
+# Classes up to this many characters are matched with a set
+_MAX_CLASS_SET = 256
+
+
+class _Entry(NamedTuple):
+    """What the compile cache holds for a pattern."""
+
+    line_start: bool
+    line_end: bool
+    state_machine: CompiledAutomaton
+    partial_state_machine: CompiledAutomaton
+    universal: frozenset[int]
+    partial_universal: frozenset[int]
+    prefilter: Prefilter | None
+    min_length: int
+    max_length: int | None
+    first_chars: str | None
+    vars: dict[str, CompiledAutomaton]
+    # The engine "auto" picks, with the string or characters the "literal"
+    # and "class" engines compare against
+    auto_engine: str
+    literal: str | None
+    char_class: CharClass | frozenset[str] | None
+    # DFAs by their `max_dfa_states`, the `BitNFA`s and the `BatchDFA`s, built
+    # when first needed
+    dfas: dict
+    # Automata of `Regex.finditer` and `Regex.groups`, built when first needed
+    searchers: dict
+
+
+def _entry(
+    line_start: bool,
+    line_end: bool,
+    state_machine: CompiledAutomaton,
+    prefilter: Prefilter | None,
+    vars: dict[str, CompiledAutomaton],
+) -> _Entry:
+    """What the compile cache holds for a pattern."""
+    # Partial match
+    partial_state_machine = state_machine.unanchored(not line_start, not line_end)
+    # Once one of these is active the haystack is accepted whatever follows
+    universal = state_machine.universal_states()
+    partial_universal = partial_state_machine.universal_states()
+    # The analyses can't count, they see A{m,n} as A+, which is safe for
+    # the bounds and first characters: every match is still covered
+    uncounted = state_machine.uncounted()
+    # Shortest and longest match, to reject haystacks by their length alone
+    min_length, max_length = length_bounds(uncounted) or (0, None)
+    # The characters a match can start with, searched for with `str.find`
+    first = first_chars(uncounted)
+    if first is not None:
+        if sum(hi - lo + 1 for lo, hi in first.ranges) > _MAX_FIRST_CHARS:
+            first = None
+        else:
+            first = "".join(
+                chr(o) for lo, hi in first.ranges for o in range(lo, hi + 1)
+            )
+    # A+ only accepts one string or only single characters where A{m,n}
+    # does too
+    auto_engine = "nfa"
+    literal = literal_string(uncounted)
+    char_class = single_class(uncounted)
+    if literal is not None:
+        auto_engine = "literal"
+    elif char_class is not None:
+        auto_engine = "class"
+        if sum(hi - lo + 1 for lo, hi in char_class.ranges) <= _MAX_CLASS_SET:
+            char_class = frozenset(
+                chr(o) for lo, hi in char_class.ranges for o in range(lo, hi + 1)
+            )
+    elif partial_state_machine.size <= BitNFA.MAX_STATES and not state_machine.markers:
+        auto_engine = "bits"
+    return _Entry(
+        line_start=line_start,
+        line_end=line_end,
+        state_machine=state_machine,
+        partial_state_machine=partial_state_machine,
+        universal=universal,
+        partial_universal=partial_universal,
+        prefilter=prefilter,
+        min_length=min_length,
+        max_length=max_length,
+        first_chars=first,
+        vars=vars,
+        auto_engine=auto_engine,
+        literal=literal,
+        char_class=char_class,
+        dfas={},
+        searchers={},
+    )
+
+
+def _pack_str(text: str) -> bytes:
+    data = text.encode()
+    return struct.pack("<I", len(data)) + data
+
+
+def _unpack_str(buffer, offset: int) -> tuple[str, int]:
+    (length,) = struct.unpack_from("<I", buffer, offset)
+    offset += 4
+    if offset + length > len(buffer):
+        raise ValueError(_CORRUPT)
+    return str(buffer[offset : offset + length], "utf-8"), offset + length
+
+
+def _lex(needle: str) -> tuple[list[reparser.Token], bool, bool]:
+    """The tokens of `needle` without a leading `^` or trailing `$`."""
+    line_start = False
+    line_end = False
+    tokens = reparser.lexer(needle)
+    if tokens and tokens[0].kind == reparser.TokenKind.Caret:
+        tokens = tokens[1:]
+        line_start = True
+    if tokens and tokens[-1].kind == reparser.TokenKind.Dollar:
+        tokens = tokens[:-1]
+        line_end = True
+    return tokens, line_start, line_end
+
+
+# Version of the `Regex.dump` format, bumped whenever it changes
+FORMAT_VERSION = 4
+_MAGIC = b"RGXT"
+_CORRUPT = "Truncated or corrupt compiled regex"
+_HEADER = "<4sHB"
+
+
+class CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+
+
+# Compiled patterns by needle and variables, least recently used first
+_MAXCACHE = 512
+_cache: OrderedDict[tuple, _Entry] = OrderedDict()
+_cache_stats = {"hits": 0, "misses": 0}
+
+
+def cache_info() -> CacheInfo:
+    return CacheInfo(
+        _cache_stats["hits"], _cache_stats["misses"], _MAXCACHE, len(_cache)
+    )
+
+
+def purge():
+    """Empties the compile cache and resets its statistics."""
+    _cache.clear()
+    _cache_stats["hits"] = _cache_stats["misses"] = 0
 
 
 class Regex:
-    def __init__(self, needle, **vars: "Regex"):
+    # "auto" picks "literal" or "class" when the pattern allows it, else "bits"
+    # for automata small enough for it and "nfa" for the others
+    ENGINES = ("auto", "nfa", "lazy", "dfa", "bits")
+
+    def __init__(
+        self,
+        needle,
+        *,
+        engine: str = "auto",
+        max_dfa_states: int | None = None,
+        dfa_eviction: str = "flush",
+        **vars: "Regex",
+    ):
+        # Variables could have these names before the options existed, a
+        # `Regex` passed for an option is still a variable
+        if isinstance(engine, Regex):
+            vars["engine"], engine = engine, "auto"
+        if isinstance(max_dfa_states, Regex):
+            vars["max_dfa_states"], max_dfa_states = max_dfa_states, None
+        if isinstance(dfa_eviction, Regex):
+            vars["dfa_eviction"], dfa_eviction = dfa_eviction, "flush"
+        if engine not in self.ENGINES:
+            raise ValueError(f"Unknown engine '{engine}'")
+        key = (needle, tuple(sorted((k, v.state_machine) for k, v in vars.items())))
+        entry = _cache.get(key)
+        if entry is None:
+            _cache_stats["misses"] += 1
+            entry = self._compile(needle, vars)
+            _cache[key] = entry
+            if len(_cache) > _MAXCACHE:
+                _cache.popitem(last=False)
+        else:
+            _cache_stats["hits"] += 1
+            _cache.move_to_end(key)
+        self._setup(needle, entry, engine, max_dfa_states, dfa_eviction)
+
+    def _setup(
+        self,
+        needle: str,
+        entry: _Entry,
+        engine: str,
+        max_dfa_states: int | None,
+        dfa_eviction: str,
+    ):
         self.needle = needle
-        line_start = False
-        line_end = False
-        tokens = reparser.lexer(needle)
-        if tokens and tokens[0].kind == reparser.TokenKind.Caret:
-            tokens = tokens[1:]
-            line_start = True
-        if tokens and tokens[-1].kind == reparser.TokenKind.Dollar:
-            tokens = tokens[:-1]
-            line_end = True
+        self.line_start = entry.line_start
+        self.line_end = entry.line_end
+        self.state_machine = entry.state_machine
+        self.partial_state_machine = entry.partial_state_machine
+        self.universal = entry.universal
+        self.partial_universal = entry.partial_universal
+        self.prefilter = entry.prefilter
+        self.min_length = entry.min_length
+        self.max_length = entry.max_length
+        self.first_chars = entry.first_chars
+        self._vars = entry.vars
+        self._dfas = dfas = entry.dfas
+        self._searchers = entry.searchers
+        self.max_dfa_states = None
+
+        # Checked here for every engine, even those that don't use them
+        if max_dfa_states is not None and max_dfa_states < 2:
+            raise ValueError("max_dfa_states must be at least 2")
+        if dfa_eviction not in LazyDFA.EVICTION_POLICIES:
+            raise ValueError(f"Unknown eviction policy '{dfa_eviction}'")
+
+        if engine == "auto":
+            engine = entry.auto_engine
+            self.literal = entry.literal
+            self.char_class = entry.char_class
+            if (
+                engine == "bits"
+                and max_dfa_states is not None
+                and self.partial_state_machine.size > max_dfa_states
+            ):
+                engine = "nfa"
+        self.engine = engine
+        if engine == "lazy":
+            if max_dfa_states is None:
+                max_dfa_states = LazyDFA.MAX_STATES
+            self.max_dfa_states = max_dfa_states
+            self.dfa = LazyDFA(self.state_machine, max_dfa_states, dfa_eviction)
+            self.partial_dfa = LazyDFA(
+                self.partial_state_machine, max_dfa_states, dfa_eviction
+            )
+        elif engine == "bits":
+            if max_dfa_states is None:
+                max_dfa_states = BitNFA.MAX_STATES
+            # The tables only ever get filled in, they can be shared
+            key = "bits", max_dfa_states
+            if key not in dfas:
+                dfas[key] = (
+                    BitNFA(self.state_machine, max_dfa_states),
+                    BitNFA(self.partial_state_machine, max_dfa_states),
+                )
+            self.dfa, self.partial_dfa = dfas[key]
+        elif engine == "dfa":
+            if max_dfa_states is None:
+                max_dfa_states = DFA.MAX_STATES
+            self.max_dfa_states = max_dfa_states
+            # Ahead-of-time DFAs are immutable and shared, lazy ones are not
+            if max_dfa_states not in dfas:
+                dfas[max_dfa_states] = (
+                    DFA(self.state_machine, max_dfa_states),
+                    DFA(self.partial_state_machine, max_dfa_states),
+                )
+            self.dfa, self.partial_dfa = dfas[max_dfa_states]
 
+    @staticmethod
+    def _compile(needle: str, vars: dict[str, "Regex"]) -> _Entry:
         automaton_vars = {k: v.state_machine for k, v in vars.items()}
-        self.state_machine = reparser.Parser(tokens, vars=automaton_vars).parse()
-
-        # Partial match
-        if not line_start:
-            tokens = reparser.lexer(".*") + tokens
-        if not line_end:
-            tokens += reparser.lexer(".*")
-        self.partial_state_machine = reparser.Parser(
-            tokens, vars=automaton_vars
+        tokens, line_start, line_end = _lex(needle)
+        state_machine = reparser.Parser(
+            tokens, vars=automaton_vars, construction="glushkov"
         ).parse()
 
-        self.state_machine = optimize_automaton(self.state_machine)
-        self.partial_state_machine = optimize_automaton(self.partial_state_machine)
+        # The mutable graph is only needed while building
+        state_machine = CompiledAutomaton.compile(optimize_automaton(state_machine))
+        # Literals every match contains, to skip the automaton on most misses
+        prefilter = Prefilter.from_automaton(state_machine.uncounted())
+        return _entry(line_start, line_end, state_machine, prefilter, automaton_vars)
+
+    def dump(self) -> bytes:
+        """
+        The compiled pattern in a versioned binary format that `load` turns
+        back into a `Regex` without parsing or optimizing anything.
+        """
+        flags = self.line_start | self.line_end << 1
+        parts = [
+            struct.pack(_HEADER, _MAGIC, FORMAT_VERSION, flags),
+            _pack_str(self.needle),
+        ]
+        if self.prefilter is None:
+            parts.append(struct.pack("<i", -2))
+        else:
+            max_prefix = self.prefilter.max_prefix
+            parts.append(struct.pack("<i", -1 if max_prefix is None else max_prefix))
+            parts.append(struct.pack("<I", len(self.prefilter.literals)))
+            parts += [_pack_str(literal) for literal in self.prefilter.literals]
+        parts.append(self.state_machine.to_bytes())
+        # `groups` parses the needle again and needs the variables for it
+        parts.append(struct.pack("<I", len(self._vars)))
+        for name, var in sorted(self._vars.items()):
+            parts += [_pack_str(name), var.to_bytes()]
+        return b"".join(parts)
+
+    @staticmethod
+    def load(
+        data,
+        engine: str = "auto",
+        max_dfa_states: int | None = None,
+        dfa_eviction: str = "flush",
+    ) -> "Regex":
+        """
+        A `Regex` from what `dump` wrote. `data` can be any buffer, e.g. an
+        `mmap` of a file, only the parts that are needed are copied.
+        """
+        if engine not in Regex.ENGINES:
+            raise ValueError(f"Unknown engine '{engine}'")
+        if len(data) < struct.calcsize(_HEADER):
+            raise ValueError(_CORRUPT)
+        magic, version, flags = struct.unpack_from(_HEADER, data, 0)
+        if magic != _MAGIC:
+            raise ValueError("Not a compiled regex")
+        if version != FORMAT_VERSION:
+            raise ValueError(f"Unsupported compiled regex format version {version}")
+        try:
+            needle, offset = _unpack_str(data, struct.calcsize(_HEADER))
+            (max_prefix,) = struct.unpack_from("<i", data, offset)
+            offset += 4
+            prefilter = None
+            if max_prefix != -2:
+                (count,) = struct.unpack_from("<I", data, offset)
+                offset += 4
+                literals = []
+                for _ in range(count):
+                    literal, offset = _unpack_str(data, offset)
+                    literals.append(literal)
+                prefilter = Prefilter(
+                    tuple(literals), None if max_prefix < 0 else max_prefix
+                )
+            state_machine, offset = CompiledAutomaton.from_buffer(data, offset)
+            (count,) = struct.unpack_from("<I", data, offset)
+            offset += 4
+            vars = {}
+            for _ in range(count):
+                name, offset = _unpack_str(data, offset)
+                vars[name], offset = CompiledAutomaton.from_buffer(data, offset)
+        except struct.error:
+            raise ValueError(_CORRUPT) from None
+        entry = _entry(bool(flags & 1), bool(flags & 2), state_machine, prefilter, vars)
+        regex = Regex.__new__(Regex)
+        regex._setup(needle, entry, engine, max_dfa_states, dfa_eviction)
+        return regex
 
     def full_match(self, haystack) -> bool:
-        return self._match(haystack, self.state_machine)
+        if self.engine == "literal":
+            return haystack == self.literal
+        if self.engine == "class":
+            return len(haystack) == 1 and haystack in self.char_class
+        if not self._length_fits(haystack):
+            return False
+        if self.prefilter is not None and self.prefilter.find(haystack) < 0:
+            return False
+        if self.engine != "nfa":
+            return self.dfa.match(haystack)
+        return self.state_machine.match(haystack, self.universal)
 
     def match(self, haystack) -> bool:
-        return self._match(haystack, self.partial_state_machine)
-
-    def _match(self, haystack, state_machine) -> bool:
-        nodes = {state_machine.start}
-        for c in haystack:
-            nodes = self._get_all_trivial(nodes)
-            nodes = self._get_all_matches(nodes, c)
-            if not nodes:
-                # Will this be relevant, when we optimize the automaton/graph?
+        if self.engine == "literal":
+            if self.line_start:
+                if self.line_end:
+                    return haystack == self.literal
+                return haystack.startswith(self.literal)
+            if self.line_end:
+                return haystack.endswith(self.literal)
+            return self.literal in haystack
+        if self.engine == "class":
+            if self.line_start or self.line_end:
+                if self.line_start and self.line_end and len(haystack) != 1:
+                    return False
+                char = haystack[:1] if self.line_start else haystack[-1:]
+                return char != "" and char in self.char_class
+            if isinstance(self.char_class, frozenset):
+                return not self.char_class.isdisjoint(haystack)
+            return any(c in self.char_class for c in haystack)
+        if len(haystack) < self.min_length:
+            return False
+        if self.line_start and self.line_end and not self._length_fits(haystack):
+            return False
+        start = 0
+        if self.prefilter is not None:
+            start = self.prefilter.find(haystack)
+            if start < 0:
                 return False
-        nodes = self._get_all_trivial(nodes)
-        return state_machine.end in nodes
+        if not self.line_start:
+            if self.first_chars is not None:
+                # A match can only start at one of the first characters
+                start = min(
+                    (
+                        i
+                        for c in self.first_chars
+                        if (i := haystack.find(c, start)) >= 0
+                    ),
+                    default=-1,
+                )
+                if start < 0:
+                    return False
+            if start:
+                haystack = haystack[start:]
+        if self.engine != "nfa":
+            return self.partial_dfa.match(haystack)
+        return self.partial_state_machine.match(haystack, self.partial_universal)
+
+    def search(self, haystack: str) -> tuple[int, int] | None:
+        """The span `(start, end)` of the leftmost-longest match, if any."""
+        return next(self.finditer(haystack), None)
+
+    def finditer(self, haystack: str) -> Iterator[tuple[int, int]]:
+        """
+        The spans `(start, end)` of the leftmost-longest matches that don't
+        overlap, from left to right. The search goes on after each match, or
+        one character later after an empty one.
+
+        The reversed pattern reads the haystack once, backwards, with a new
+        thread starting at every position. Threads in the same state accept
+        the same starts from then on, so only the one that started furthest
+        right is kept and a step costs at most one set of states per distinct
+        end, which makes the search linear in the haystack whatever the
+        pattern. It runs on the compiled automaton for every engine.
+        """
+        n = len(haystack)
+        if n < self.min_length:
+            return
+        if self.prefilter is not None and self.prefilter.find(haystack) < 0:
+            return
+        if self.engine == "literal" and not (self.line_start or self.line_end):
+            start = haystack.find(self.literal)
+            while start >= 0:
+                end = start + len(self.literal)
+                yield start, end
+                start = haystack.find(self.literal, end if end > start else end + 1)
+            return
+        reverse = self._searchers.get("reverse")
+        if reverse is None:
+            reverse = CompiledAutomaton.compile(
+                optimize_automaton(self.state_machine.to_automaton().reverse())
+            )
+            self._searchers["reverse"] = reverse
+        accept = reverse.accept
+        seed = reverse.start_states()
+        # The end of the longest match starting at each position
+        ends: list[int | None] = [None] * (n + 1)
+        # Sets of states by the end of their match, furthest end first
+        threads: list[tuple[int, set[int]]] = []
+        active: set[int] = set()
+        for i in range(n, -1, -1):
+            if i == n or not self.line_end:
+                new = seed - active
+                if new:
+                    threads.append((i, new))
+            for end, states in threads:
+                if any(accept >> s & 1 for s in states):
+                    ends[i] = end
+                    break
+            if i == 0 or self.line_end and not threads:
+                break
+            class_id = reverse.class_of(haystack[i - 1])
+            active = set()
+            next_threads = []
+            for end, states in threads:
+                states = reverse.step_class(states, class_id) - active
+                if states:
+                    next_threads.append((end, states))
+                    active |= states
+            threads = next_threads
+        pos = 0
+        for start in range(1 if self.line_start else n + 1):
+            end = ends[start]
+            if start < pos or end is None:
+                continue
+            yield start, end
+            pos = end if end > start else end + 1
+
+    def groups(self, haystack: str) -> tuple[str | None, ...] | None:
+        """
+        The text of every capture group in the match `search` finds, `None`
+        for groups that didn't take part in it. `None` if there is no match.
+
+        Within the match the groups are those of a backtracking engine that
+        prefers greedy repetitions and the left branch of a choice. They are
+        found with a Pike VM, in time linear in the length of the match.
+        """
+        span = self.search(haystack)
+        if span is None:
+            return None
+        vm = self._searchers.get("pike")
+        if vm is None:
+            tokens, _, _ = _lex(self.needle)
+            parser = reparser.Parser(tokens, vars=self._vars, ordered_choice=True)
+            vm = PikeVM(parser.parse(), parser.groups)
+            self._searchers["pike"] = vm
+        slots = vm.full_match(haystack, *span)
+        return tuple(
+            None if start is None or end is None else haystack[start:end]
+            for start, end in zip(slots[::2], slots[1::2])
+        )
+
+    def _length_fits(self, haystack) -> bool:
+        return self.min_length <= len(haystack) and (
+            self.max_length is None or len(haystack) <= self.max_length
+        )
+
+    def matcher(self, full: bool = False) -> "Matcher":
+        """
+        A matcher that is fed the haystack in chunks, like `match` or, with
+        `full`, `full_match` on the concatenation of all chunks.
+        """
+        return Matcher(self, full)
+
+    def match_many(
+        self,
+        haystacks: Iterable[str],
+        workers: int = 1,
+        chunksize: int = 1024,
+        vectorized: bool = False,
+    ) -> Iterator[bool]:
+        """
+        `match` for every haystack, in order, spread over `workers`. With
+        `vectorized`, batches of `chunksize` haystacks run through the DFA
+        together with NumPy instead, or one by one in this process when the
+        DFA would be too large.
+        """
+        return self._many(haystacks, False, workers, chunksize, vectorized)
+
+    def full_match_many(
+        self,
+        haystacks: Iterable[str],
+        workers: int = 1,
+        chunksize: int = 1024,
+        vectorized: bool = False,
+    ) -> Iterator[bool]:
+        """`full_match` for every haystack, like `match_many`."""
+        return self._many(haystacks, True, workers, chunksize, vectorized)
+
+    def _many(
+        self,
+        haystacks: Iterable[str],
+        full: bool,
+        workers: int,
+        chunksize: int,
+        vectorized: bool,
+    ) -> Iterator[bool]:
+        if workers < 1 or chunksize < 1:
+            raise ValueError("workers and chunksize must be positive")
+        if vectorized:
+            if workers != 1:
+                raise ValueError("The vectorized backend runs in one process")
+            return self._vectorized(iter(haystacks), full, chunksize)
+        if workers == 1:
+            return map(self.full_match if full else self.match, haystacks)
+        return self._pooled(iter(haystacks), full, workers, chunksize)
+
+    def _pooled(
+        self, haystacks: Iterator[str], full: bool, workers: int, chunksize: int
+    ) -> Iterator[bool]:
+        batches = iter(lambda: list(itertools.islice(haystacks, chunksize)), [])
+        # Threads can use this pattern directly, processes get it once at start
+        gil = getattr(sys, "_is_gil_enabled", lambda: True)()
+        if not gil and self.engine != "lazy":
+            executor, shared = ThreadPoolExecutor(workers), self
+        else:
+            executor = ProcessPoolExecutor(
+                workers, initializer=_init_worker, initargs=(self,)
+            )
+            shared = None
+        with executor:
+            # Only a few batches are in flight, `haystacks` may be huge
+            pending = deque()
+            for batch in batches:
+                pending.append(executor.submit(_match_batch, full, batch, shared))
+                if len(pending) >= 2 * workers:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+
+    def _vectorized(
+        self, haystacks: Iterator[str], full: bool, chunksize: int
+    ) -> Iterator[bool]:
+        batch_dfas = self._batch_dfas()
+        if batch_dfas is None:
+            # No table to vectorize, every haystack runs on this regex's engine
+            yield from map(self.full_match if full else self.match, haystacks)
+            return
+        batch_dfa = batch_dfas[0 if full else 1]
+        for batch in iter(lambda: list(itertools.islice(haystacks, chunksize)), []):
+            yield from batch_dfa.match(batch).tolist()
+
+    def _batch_dfas(self) -> tuple[BatchDFA, BatchDFA] | None:
+        """
+        The full and the partial DFA for NumPy, built when first needed.
+        `None` if the DFA would have more than `DFA.MAX_STATES` states.
+        """
+        if "numpy" not in self._dfas:
+            if self.engine == "dfa":
+                dfa, partial_dfa = self.dfa, self.partial_dfa
+            else:
+                if DFA.MAX_STATES not in self._dfas:
+                    try:
+                        self._dfas[DFA.MAX_STATES] = (
+                            DFA(self.state_machine),
+                            DFA(self.partial_state_machine),
+                        )
+                    except ValueError:
+                        self._dfas["numpy"] = None
+                        return None
+                dfa, partial_dfa = self._dfas[DFA.MAX_STATES]
+            self._dfas["numpy"] = BatchDFA(dfa), BatchDFA(partial_dfa)
+        return self._dfas["numpy"]
+
+    def scan_file(
+        self, path: str, full: bool = False
+    ) -> Iterator[tuple[int, int, str]]:
+        """
+        The line number, byte offset and text of every line of the UTF-8 file
+        at `path` that matches. The file is memory mapped and only lines that
+        contain the prefilter literals are decoded.
+        """
+        literals = []
+        if self.prefilter is not None:
+            literals = [literal.encode() for literal in self.prefilter.literals]
+        check = self.full_match if full else self.match
+        with _map_file(path) as data:
+            start = 0
+            line_number = 0
+            while start < len(data):
+                line_number += 1
+                end = data.find(b"\n", start)
+                if end < 0:
+                    end = len(data)
+                if all(data.find(literal, start, end) >= 0 for literal in literals):
+                    line = data[start:end].decode(errors="replace")
+                    if check(line):
+                        yield line_number, start, line
+                start = end + 1
+
+    def match_file(self, path: str, full: bool = False, chunk_size: int = 1 << 16):
+        """Matches the whole UTF-8 file at `path` as one haystack."""
+        matcher = self.matcher(full)
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        with _map_file(path) as data:
+            for pos in range(0, len(data), chunk_size):
+                chunk = decoder.decode(data[pos : pos + chunk_size])
+                if matcher.feed(chunk) is not None:
+                    return matcher.result
+        matcher.feed(decoder.decode(b"", final=True))
+        return matcher.finish()
+
+
+# The pattern of a `match_many` worker
+_worker_regex = None
+
+
+def _init_worker(regex: Regex):
+    global _worker_regex
+    _worker_regex = regex
+
+
+def _match_batch(
+    full: bool, haystacks: list[str], regex: Regex | None = None
+) -> list[bool]:
+    regex = regex or _worker_regex
+    check = regex.full_match if full else regex.match
+    return [check(haystack) for haystack in haystacks]
+
+
+class _map_file:
+    """Read-only memory map of a file, `b""` for empty files."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def __enter__(self) -> mmap.mmap | bytes:
+        with open(self.path, "rb") as f:
+            try:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files cannot be mapped
+                self.data = b""
+        return self.data
+
+    def __exit__(self, *exc):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+
+class Matcher:
+    """
+    Runs a `Regex` over input that arrives in pieces, keeping only the active
+    states between `feed` calls. `result` becomes `True` as soon as no input
+    can undo the match and `False` once nothing can match anymore, it stays
+    `None` while that is still open. `finish` ends the input.
+    """
+
+    def __init__(self, regex: Regex, full: bool = False):
+        # The specialized engines have no state to carry between chunks
+        self.engine = regex.engine if regex.engine in ("lazy", "dfa", "bits") else "nfa"
+        if self.engine == "nfa":
+            self.runner = regex.state_machine if full else regex.partial_state_machine
+            self.state = self.runner.start_states()
+            self.universal = regex.universal if full else regex.partial_universal
+        else:
+            self.runner = regex.dfa if full else regex.partial_dfa
+            self.state = self.runner.start
+            if self.engine in ("lazy", "bits"):
+                self.universal = self.runner.universal
+        self.result = None
+        self._update()
+
+    def feed(self, chunk: str) -> bool | None:
+        if self.result is None:
+            if self.engine == "nfa":
+                self.state = self.runner.run(chunk, self.state, self.universal)
+            else:
+                self.state = self.runner.run(chunk, self.state)
+            self._update()
+        return self.result
+
+    def finish(self) -> bool:
+        if self.result is None:
+            if self.engine == "nfa":
+                self.result = self.runner.accepts(self.state)
+            elif self.engine == "lazy":
+                self.result = self.state.accepting
+            elif self.engine == "bits":
+                self.result = bool(self.state & self.runner.accept)
+            else:
+                self.result = self.runner.accepting[self.state]
+        return self.result
+
+    def _update(self):
+        if self.engine == "nfa":
+            alive = bool(self.state)
+            universal = not self.universal.isdisjoint(self.state)
+        elif self.engine == "lazy":
+            alive = bool(self.state.states)
+            universal = not self.universal.isdisjoint(self.state.states)
+        elif self.engine == "bits":
+            alive = bool(self.state)
+            universal = bool(self.state & self.universal)
+        else:
+            alive = self.state != self.runner.dead
+            universal = self.runner.universal[self.state]
+        if universal:
+            self.result = True
+        elif not alive:
+            self.result = False
+
+
+class RegexSet:
+    """
+    Many patterns compiled into a single automaton, so one pass over the
+    haystack tells which of them match. Every pattern keeps its own accepting
+    state, the results are the indices of the matching patterns.
+    """
+
+    def __init__(self, needles: list[str], **vars: Regex):
+        self.needles = list(needles)
+        automaton_vars = {k: v.state_machine for k, v in vars.items()}
+        full, partial = [], []
+        for needle in self.needles:
+            tokens, line_start, line_end = _lex(needle)
+            full.append(
+                reparser.Parser(
+                    tokens, vars=automaton_vars, construction="glushkov"
+                ).parse()
+            )
+            # Each pattern has its own anchors, so `.*` is added per pattern
+            if not line_start:
+                tokens = reparser.lexer(".*") + tokens
+            if not line_end:
+                tokens += reparser.lexer(".*")
+            partial.append(
+                reparser.Parser(
+                    tokens, vars=automaton_vars, construction="glushkov"
+                ).parse()
+            )
+        self.state_machine = self._combine(full)
+        self.partial_state_machine = self._combine(partial)
 
     @staticmethod
-    def _get_all_matches(nodes: set, c: str) -> set:
-        new_nodes = set()
-        for node in nodes:
-            new_nodes.update(node.match(c))
-        return new_nodes
+    def _combine(autos: list[Automaton]) -> CompiledAutomaton | None:
+        if not autos:
+            return None
+        combined = autos[0].choice(*autos[1:])
+        return CompiledAutomaton.compile(
+            optimize_automaton(combined), ends=[a.end for a in autos]
+        )
 
     @staticmethod
-    def _get_all_trivial(nodes: set) -> set:
-        new_nodes = set(nodes)
-        while new_nodes:
-            new_new_nodes = set()
-            for node in new_nodes:
-                new_new_nodes.update(node.trivial_neigbours - nodes)
-                nodes.update(node.trivial_neigbours)
-            new_nodes = new_new_nodes
-        return nodes
+    def _matching(auto: CompiledAutomaton | None, haystack: str) -> list[int]:
+        if auto is None:
+            return []
+        states = auto.run(haystack)
+        return [idx for idx, end in enumerate(auto.ends) if end in states]
+
+    def full_match(self, haystack: str) -> list[int]:
+        return self._matching(self.state_machine, haystack)
+
+    def match(self, haystack: str) -> list[int]:
+        return self._matching(self.partial_state_machine, haystack)
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m regex", description="Print the lines that match PATTERN."
+    )
+    parser.add_argument("pattern")
+    parser.add_argument("files", nargs="+")
+    parser.add_argument(
+        "-x", "--line-regexp", action="store_true", help="match whole lines only"
+    )
+    parser.add_argument(
+        "-c", "--count", action="store_true", help="print only a count per file"
+    )
+    parser.add_argument(
+        "--whole-file",
+        action="store_true",
+        help="match each file as one haystack and print the matching files",
+    )
+    parser.add_argument("--engine", choices=Regex.ENGINES, default="auto")
+    args = parser.parse_args(argv)
+
+    regex = Regex(args.pattern, engine=args.engine)
+    prefix = len(args.files) > 1
+    found = False
+    for path in args.files:
+        if args.whole_file:
+            if regex.match_file(path, args.line_regexp):
+                found = True
+                print(path)
+            continue
+        count = 0
+        for line_number, offset, line in regex.scan_file(path, args.line_regexp):
+            count += 1
+            if not args.count:
+                name = f"{path}:" if prefix else ""
+                print(f"{name}{line_number}:{offset}:{line}")
+        if args.count:
+            print(f"{path}:{count}" if prefix else count)
+        found = found or count > 0
+    return 0 if found else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,9 +1,12 @@
 import typing
-import string
 from dataclasses import dataclass, field
 from enum import IntEnum, auto
 
-from automaton import Automaton
+import charclass
+from automaton import Automaton, Call, Counter, Node, reachable
+from charclass import CharClass
+from compiled import CompiledAutomaton
+from optimizer import position_automaton
 
 
 class TokenKind(IntEnum):
@@ -88,42 +91,78 @@ class Parser:
     """
     Precedence:
      - Literal
-     - Grouping ()
+     - Grouping (), also a capture group numbered by its opening parenthesis
      - Digit: \d = [0123456789]
      - Word: \w = [a-zA-Z0-9_]
      - Whitespace: \s = [ \t\n\r\f]
      - Bracket [abc] = (a|b|c)
-     - Variable {a} = insert variable a
+     - Variable {a} = insert variable a, all references share one copy when
+       copying would take too many nodes
      - Range A{3} = AAA
-     - Range A{1,3} = A(|A(|A))
+     - Range A{1,3} = A(|A(|A)), large ones keep a single copy of A and count
      - OneOrMore: A+ = AA*
      - Optional: A? = (A|)
      - Clojure A* = (|A|AA|AAA|...)
      - Concatination AB
-     - Choice (A|B)
+     - Choice (A|B), a trie if all choices are literals
     """
 
+    # Largest count in A{m,n}
+    MAX_REPEAT: typing.ClassVar[int] = 1000
+    # A{m,n} is copied out while that takes at most this many nodes, which
+    # every engine and analysis handles directly, else it becomes a `Counter`.
+    # Likewise a variable gets copied into every reference, else a `Call`.
+    MAX_COPIED_NODES: typing.ClassVar[int] = 256
+    CONSTRUCTIONS: typing.ClassVar[tuple[str, ...]] = ("thompson", "glushkov")
+
     tokens: list[Token]
     idx: int = 0
-    vars: dict[str, Automaton] = field(default_factory=dict)
+    vars: dict[str, CompiledAutomaton] = field(default_factory=dict)
+    # "glushkov" turns the result into a position automaton without epsilons
+    construction: str = "thompson"
+    # Keep the branches of a choice in order, which `pikevm.PikeVM` relies
+    # on, instead of merging literal ones into a trie
+    ordered_choice: bool = False
+    # Number of capture groups seen so far, see `pikevm.PikeVM` for the tags
+    groups: int = 0
+    # How often each variable is referred to, and the shared copies of the
+    # variables that are too large to copy into every reference
+    references: dict[str, int] = field(default_factory=dict)
+    calls: dict[str, Call] = field(default_factory=dict)
 
     def parse(self) -> Automaton:
+        if self.construction not in self.CONSTRUCTIONS:
+            raise ValueError(f"Unknown construction '{self.construction}'")
         if not self.tokens:
             return Automaton.empty()
 
+        self.references = self.count_references()
         result = self.parse_choice()
         assert self.idx == len(
             self.tokens
         ), f"Unable to parse regex: parsed {self.idx}/{len(self.tokens)} {self.tokens[:self.idx]} but not {self.tokens[self.idx:]}"
+        if self.construction == "glushkov":
+            result = position_automaton(result)
         return result
 
     def parse_choice(self) -> Automaton:
         """a|b|c|d|g|h|l"""
+        spans = [self.idx]
         left = self.parse_concat()
         choices = []
         while self.consume(TokenKind.Pipe):
+            spans.append(self.idx)
             choices.append(self.parse_concat())
         if choices:
+            spans.append(self.idx + 1)
+            words = [
+                self.tokens[start : end - 1] for start, end in zip(spans, spans[1:])
+            ]
+            if not self.ordered_choice and all(
+                t.kind == TokenKind.Literal for word in words for t in word
+            ):
+                # Only literals, share common prefixes instead of one branch each
+                return Automaton.trie(["".join(t.value for t in w) for w in words])
             left = left.choice(*choices)
         return left
 
@@ -157,7 +196,9 @@ class Parser:
     def parse_one_or_more(self) -> Automaton:
         left = self.parse_range()
         if self.consume(TokenKind.Plus):
-            left = left.concat(left.clone().clojure())
+            # Looping back to the start repeats A without a second copy, every
+            # path that takes the loop is a sequence of paths through A
+            left.end.connect_trivial(left.start)
         return left
 
     def parse_range(self) -> Automaton:
@@ -178,14 +219,47 @@ class Parser:
 
             assert self.consume(TokenKind.CloseBrace)
             assert min <= max
-            orig = left
+            if max > self.MAX_REPEAT:
+                raise ValueError(
+                    f"Repetition count {max} is larger than {self.MAX_REPEAT}"
+                )
+            if max * len(reachable(left.start)) > self.MAX_COPIED_NODES:
+                return self.counted(left, min, max)
+            copies = [left] + [left.clone() for _ in range(max - 1)]
             left = Automaton.empty()
-            for _ in range(min):
-                left = left.concat(orig.clone())
-            for _ in range(max - min):
-                left = left.concat(Automaton.empty().choice(orig.clone()))
+            for copy in copies[:min]:
+                left = left.concat(copy)
+            if max > min:
+                # A{0,3} = (A(A(A)?)?)? with a single shared end. Chaining
+                # (A|)(A|)(A|) instead would make every epsilon closure hold
+                # all the following copies, quadratic in the count.
+                end = Node()
+                optional_start = end
+                for copy in copies[min:]:
+                    start = Node()
+                    start.connect_trivial(copy.start)
+                    start.connect_trivial(end)
+                    copy.end.connect_trivial(optional_start)
+                    optional_start = start
+                left = left.concat(Automaton(optional_start, end))
         return left
 
+    @staticmethod
+    def counted(body: Automaton, low: int, high: int) -> Automaton:
+        """A{low,high} around a single copy of A, see `Counter`."""
+        start, enters, leaves, exit = Node(), Node(), Node(), Node()
+        # Only a pass through A leads to the exit, A{0,n} is (A{1,n})?
+        counter = Counter(max(low, 1), high, body.start, exit)
+        enters.enters = leaves.leaves = counter
+        # Edges into the markers only, so loops around the repetition can be
+        # built like around any other automaton
+        start.connect_trivial(enters)
+        body.end.connect_trivial(leaves)
+        result = Automaton(start, exit)
+        if low == 0:
+            result = result.choice(Automaton.empty())
+        return result
+
     def parse_variable(self) -> Automaton:
         if self.consume(TokenKind.OpenBrace):
             assert (
@@ -209,10 +283,43 @@ class Parser:
 
             assert name in self.vars, f"Variable {name} is not defined"
 
-            return self.vars[name].clone()
+            var = self.vars[name]
+            if self.references[name] * var.size <= self.MAX_COPIED_NODES:
+                return var.to_automaton()
+            return self.call(name)
 
         return self.parse_bracket()
 
+    def count_references(self) -> dict[str, int]:
+        """How often each variable is referred to in the tokens."""
+        references = dict.fromkeys(self.vars, 0)
+        for idx, token in enumerate(self.tokens):
+            if token.kind != TokenKind.OpenBrace:
+                continue
+            name = ""
+            for token in self.tokens[idx + 1 :]:
+                if token.kind != TokenKind.Literal:
+                    break
+                name += token.value
+            if name in references:
+                references[name] += 1
+        return references
+
+    def call(self, name: str) -> Automaton:
+        """A reference to the one copy of variable `name`, see `Call`."""
+        if name not in self.calls:
+            body = self.vars[name].to_automaton()
+            returns = Node()
+            body.end.connect_trivial(returns)
+            self.calls[name] = returns.returns = Call(body.start, [])
+        call = self.calls[name]
+        start, site, exit = Node(), Node(), Node()
+        site.calls = call, len(call.exits)
+        call.exits.append(exit)
+        # Like `counted`, edges into the marker only
+        start.connect_trivial(site)
+        return Automaton(start, exit)
+
     def parse_bracket(self) -> Automaton:
         if self.consume(TokenKind.OpenBracket):
             is_negative = self.consume(TokenKind.Caret)
@@ -222,51 +329,54 @@ class Parser:
                 self.idx += 1
             assert len(lits) > 0
             result = Automaton()
-            all_lits = set()
+            ranges = []
             for idx, lit in enumerate(lits):
                 if lit == "-" and idx > 0 and idx < len(lits) - 1:
-                    start = lits[idx - 1]
-                    end = lits[idx + 1]
-                    for i in range(ord(start), ord(end) + 1):
-                        all_lits.add(chr(i))
+                    ranges.append((ord(lits[idx - 1]), ord(lits[idx + 1])))
                 else:
-                    all_lits.add(lit)
+                    ranges.append((ord(lit), ord(lit)))
+            cls = CharClass.from_ranges(ranges)
             if is_negative:
-                result.start.connect_neg(all_lits, result.end)
-            else:
-                for lit in all_lits:
-                    result.start.connect_literal(lit, result.end)
+                cls = cls.negate()
+            result.start.connect_class(cls, result.end)
             return result
         return self.parse_whitespace()
 
     def parse_whitespace(self) -> Automaton:
         if self.consume(TokenKind.Whitespace):
             result = Automaton.none()
-            for c in " \t\r\n\f":
-                result.start.connect_literal(c, result.end)
+            result.start.connect_class(charclass.WHITESPACE, result.end)
             return result
         return self.parse_word()
 
     def parse_word(self) -> Automaton:
         if self.consume(TokenKind.Word):
             result = Automaton.none()
-            for c in string.digits + string.ascii_letters + "_":
-                result.start.connect_literal(c, result.end)
+            result.start.connect_class(charclass.WORD, result.end)
             return result
         return self.parse_digit()
 
     def parse_digit(self) -> Automaton:
         if self.consume(TokenKind.Digit):
             result = Automaton.none()
-            for c in string.digits:
-                result.start.connect_literal(c, result.end)
+            result.start.connect_class(charclass.DIGIT, result.end)
             return result
         return self.parse_group()
 
     def parse_group(self) -> Automaton:
         if self.consume(TokenKind.OpenParen):
-            result = self.parse_choice()
+            self.groups += 1
+            tag = 2 * (self.groups - 1)
+            inner = self.parse_choice()
             assert self.consume(TokenKind.CloseParen)
+            # The tagged nodes sit between plain ones, so that `clojure`, which
+            # merges the start into the end, keeps both tags
+            result = Automaton()
+            open_, close = Node(tag=tag), Node(tag=tag + 1)
+            result.start.connect_trivial(open_)
+            open_.connect_trivial(inner.start)
+            inner.end.connect_trivial(close)
+            close.connect_trivial(result.end)
             return result
         return self.parse_literal()
 
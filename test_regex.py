@@ -1,6 +1,62 @@
+import contextlib
+import io
+import mmap
+import os
+import re as std_re
+import struct
+import tempfile
+import tracemalloc
 import unittest
+import unittest.mock
 
-from regex import Regex
+import charclass
+import regex
+import vectorized
+from analysis import first_chars, length_bounds
+from automaton import Automaton, Node, reachable
+from charclass import CharClass
+from compiled import CompiledAutomaton
+from optimizer import optimize_automaton
+from regex import Regex, RegexSet, main
+from reparser import Parser, lexer
+
+
+def assert_engines(test: unittest.TestCase, needle: str, haystacks: list[str]):
+    """
+    Checks that every engine gives the results of the nfa engine for `match`,
+    `full_match`, `finditer` and matchers fed each haystack in two chunks.
+    """
+
+    def fed(matcher, haystack: str) -> bool:
+        half = len(haystack) // 2
+        matcher.feed(haystack[:half])
+        matcher.feed(haystack[half:])
+        return matcher.finish()
+
+    def results(regex: Regex, haystack: str) -> tuple:
+        return (
+            regex.match(haystack),
+            regex.full_match(haystack),
+            list(regex.finditer(haystack)),
+            fed(regex.matcher(), haystack),
+            fed(regex.matcher(full=True), haystack),
+        )
+
+    reference = Regex(needle, engine="nfa")
+    for engine in Regex.ENGINES:
+        try:
+            regex = Regex(needle, engine=engine)
+        except ValueError:
+            # Too many states or counted repetitions
+            if engine != "bits":
+                raise
+            continue
+        for haystack in haystacks:
+            test.assertEqual(
+                results(regex, haystack),
+                results(reference, haystack),
+                (needle, engine, haystack),
+            )
 
 
 class TestBasic(unittest.TestCase):
@@ -116,6 +172,18 @@ class TestOr(unittest.TestCase):
         self.assertTrue(re.full_match("p"))
         self.assertTrue(re.full_match("xyzp"))
 
+    def test_literal_trie(self):
+        words = ["car", "cart", "care", "cat", "dog", "", "c\\|"]
+        re = Regex("(" + "|".join(words) + ")x")
+        for word in ["car", "cart", "care", "cat", "dog", "", "c|"]:
+            self.assertTrue(re.full_match(word + "x"), word)
+        for word in ["ca", "cars", "do", "c"]:
+            self.assertFalse(re.full_match(word + "x"), word)
+        # Shared prefixes share their nodes: c, ca, car, cart, care, cat, d,
+        # do, dog, c|, the start and the end
+        auto = Parser(lexer("|".join(words))).parse()
+        self.assertEqual(len(reachable(auto.start)), 12)
+
 
 class TestOptional(unittest.TestCase):
     def test_simple(self):
@@ -216,6 +284,44 @@ class TestRange(unittest.TestCase):
         self.assertTrue(re.full_match("aaa"))
         self.assertFalse(re.full_match("aaaa"))
 
+    def test_large_range(self):
+        re = Regex("x\\w{2,1000}y")
+        self.assertTrue(re.full_match("x" + "a" * 1000 + "y"))
+        self.assertTrue(re.full_match("xaay"))
+        self.assertFalse(re.full_match("xay"))
+        self.assertFalse(re.full_match("x" + "a" * 1001 + "y"))
+        # Closures of the optional copies do not contain each other
+        self.assertLess(max(map(len, re.state_machine.closures)), 4)
+        self.assertRaises(ValueError, Regex, "a{1001}")
+
+    def test_counter(self):
+        re = Regex("(abc){1,1000}")
+        # A single copy of abc instead of a thousand
+        self.assertLess(re.state_machine.size, 10)
+        self.assertTrue(re.full_match("abc" * 1000))
+        self.assertFalse(re.full_match("abc" * 1001))
+        self.assertFalse(re.full_match(""))
+        self.assertEqual(re.search("xabcabcab"), (1, 7))
+        self.assertEqual(Regex.load(re.dump()).state_machine, re.state_machine)
+        self.assertTrue(Regex("<{r}>", r=re).full_match("<abcabc>"))
+
+    def test_counted_like_copied(self):
+        haystacks = ["", "ab", "abab", "ababab", "aab", "abaabab", "bab", "ababa"]
+        for needle in ["(ab){2}", "(a|ab){1,3}b", "(a?b?){2,3}", "((ab){2}a){1,2}"]:
+            copied = Regex(needle)
+            self.assertFalse(copied.state_machine.counters)
+            with unittest.mock.patch.object(Parser, "MAX_COPIED_NODES", 0):
+                regex.purge()
+                counted = Regex(needle, engine="nfa")
+                self.assertTrue(counted.state_machine.counters)
+                for haystack in haystacks:
+                    self.assertEqual(
+                        counted.full_match(haystack), copied.full_match(haystack)
+                    )
+                    self.assertEqual(counted.match(haystack), copied.match(haystack))
+                    self.assertEqual(counted.groups(haystack), copied.groups(haystack))
+            regex.purge()
+
 
 class TestOneOf(unittest.TestCase):
     def test_simplest(self):
@@ -345,6 +451,75 @@ class TestVariables(unittest.TestCase):
         a = Regex("{chars}+", chars=chars)
         self.assertTrue(a.full_match("aaaa"))
 
+    def test_option_names(self):
+        # Variables named like the options of `Regex` still work
+        re = Regex("{engine}x", engine=Regex("ab"))
+        self.assertTrue(re.full_match("abx"))
+        re = Regex(
+            "{max_dfa_states}{dfa_eviction}",
+            engine="dfa",
+            max_dfa_states=Regex("a"),
+            dfa_eviction=Regex("b"),
+        )
+        self.assertEqual(re.engine, "dfa")
+        self.assertTrue(re.full_match("ab"))
+
+    def test_no_extra_copies(self):
+        word = Regex("(ab|c)+")
+        self.assertLess(
+            word.state_machine.size, Regex("(ab|c)(ab|c)*").state_machine.size
+        )
+        twice = Regex("{word}-{word}", word=word)
+        self.assertLessEqual(twice.state_machine.size, 2 * word.state_machine.size + 1)
+        self.assertTrue(twice.full_match("abc-cab"))
+        self.assertFalse(twice.full_match("abc-"))
+
+    def test_shared(self):
+        word = Regex("(alpha|bravo|charlie|delta|echo|foxtrot)[0-9]+")
+        needle = "|".join(f"{{word}}-{n}" for n in range(20))
+        re = Regex(needle, word=word)
+        # One copy of the variable for all twenty references
+        self.assertTrue(re.state_machine.calls)
+        self.assertLess(re.state_machine.size, 4 * word.state_machine.size)
+        self.assertTrue(re.full_match("echo12-19"))
+        self.assertFalse(re.full_match("echo12-20"))
+        self.assertEqual(re.search("x golf1-2 delta7-3x"), (10, 18))
+        self.assertEqual(Regex.load(re.dump()).state_machine, re.state_machine)
+
+    def test_shared_like_copied(self):
+        haystacks = ["", "a", "bca", "abcy", "dabcyyd", "xayyabc", "xbcyax", "aad"]
+        needles = ["{v}{v}", "({v}|d)+{v}", "x({w}){1,2}", "({v})*d", "{w}d?{v}"]
+
+        def variables() -> dict[str, Regex]:
+            v = Regex("a|bc")
+            return {"v": v, "w": Regex("{v}y*", v=v)}
+
+        for needle in needles:
+            copied = Regex(needle, engine="nfa", **variables())
+            self.assertFalse(copied.state_machine.calls)
+            with unittest.mock.patch.object(Parser, "MAX_COPIED_NODES", 0):
+                regex.purge()
+                vars = variables()
+                for engine in ["nfa", "lazy", "dfa", "auto"]:
+                    shared = Regex(needle, engine=engine, **vars)
+                    self.assertTrue(shared.state_machine.calls)
+                    loaded = Regex.load(shared.dump(), engine=engine)
+                    for re in [shared, loaded]:
+                        for haystack in haystacks:
+                            self.assertEqual(re.match(haystack), copied.match(haystack))
+                            self.assertEqual(
+                                re.full_match(haystack), copied.full_match(haystack)
+                            )
+                            self.assertEqual(
+                                list(re.finditer(haystack)),
+                                list(copied.finditer(haystack)),
+                            )
+                            self.assertEqual(
+                                re.groups(haystack), copied.groups(haystack)
+                            )
+                self.assertRaises(ValueError, Regex, needle, engine="bits", **vars)
+            regex.purge()
+
 
 class TestComplex(unittest.TestCase):
     def test_email(self):
@@ -382,6 +557,825 @@ class TestComplex(unittest.TestCase):
         self.assertTrue(email.full_match('" !#"@[ksdjhfg:!--Z~]'))
 
 
+class TestEngines(unittest.TestCase):
+    def test_same_as_nfa(self):
+        cases = [
+            ("(x+x+)+y", ["xxxy", "xxxx", "y", ""]),
+            (r"\w+@\w+\.\w+", ["info@bitstamp.net", "a bob@x.com b", "info@net"]),
+            ("a.b", ["aab", "a\u1234b", "ab", "abbb"]),
+            ("[^abc]+x", ["dddx", "dax", "x", "\u1234x"]),
+            ("(ab|xy|p{4}|o+){1,3}", ["abppppxy", "abpppxy", "ooo"]),
+            ("(a|b)*abb(a|b)*c", ["abbababbc", "ab", ""]),
+            ("a.{6}b", ["a" * 9 + "b", "a" * 6 + "b"]),
+            ("(ab){2,100}c", ["ab" * 3 + "c", "abc", "ab" * 101 + "c"]),
+            ("(ab|cd)+e", ["x" * 100 + "cdabe", "abcde", "x" * 100 + "cdab", "xyz"]),
+            ("abcd|c", ["abcd", "xcx"]),
+            ("a|ab", ["xab", "aab"]),
+            ("ab+c", ["xxabbcyy", "abb"]),
+            ("a*", ["baa", ""]),
+            ("(ab)*", ["abab", "aba", ""]),
+            ("^ab+", ["abb", "xab"]),
+            ("^a", ["a", "ba"]),
+            ("a$", ["a", "ab", "ba"]),
+            ("^a.*$", ["aab", ""]),
+        ]
+        for needle, haystacks in cases:
+            assert_engines(self, needle, haystacks)
+
+
+class TestLazyDFA(unittest.TestCase):
+    def test_match(self):
+        re = Regex(r"\w+@\w+\.\w+", engine="lazy")
+        self.assertTrue(re.full_match("info@bitstamp.net"))
+        self.assertFalse(re.full_match("info@bitstampnet"))
+        self.assertTrue(re.match("mail info@bitstamp.net now"))
+        self.assertFalse(re.match("mail info@bitstampnet now"))
+
+    def test_states_are_reused(self):
+        re = Regex("(ab)*", engine="lazy")
+        self.assertTrue(re.full_match("ab" * 1000))
+        self.assertLessEqual(len(re.dfa.cache), 3)
+        self.assertFalse(re.full_match("ab" * 1000 + "a"))
+
+    def test_flush(self):
+        re = Regex("a{5}", engine="lazy", max_dfa_states=3)
+        self.assertTrue(re.full_match("aaaaa"))
+        self.assertFalse(re.full_match("aaaa"))
+        self.assertFalse(re.full_match("aaaaaa"))
+        self.assertLessEqual(len(re.dfa.cache), 3)
+        self.assertGreater(re.dfa.evictions, 0)
+
+    def test_lru(self):
+        re = Regex("a{5}", engine="lazy", max_dfa_states=3, dfa_eviction="lru")
+        for _ in range(3):
+            self.assertTrue(re.full_match("aaaaa"))
+            self.assertFalse(re.full_match("aaaa"))
+        self.assertLessEqual(len(re.dfa.cache), 3)
+        self.assertIn(re.dfa.start.states, re.dfa.cache)
+
+    def test_lru_frees_evicted(self):
+        needle = "(a|b)*a(a|b){6}"
+        re = Regex(needle, engine="lazy", max_dfa_states=8, dfa_eviction="lru")
+        for i in range(512):
+            haystack = f"{i:09b}".translate({48: "a", 49: "b"})
+            self.assertEqual(re.match(haystack), Regex(needle).match(haystack))
+        self.assertGreater(re.partial_dfa.evictions, 0)
+        # Nothing that is kept leads to an evicted state
+        found = set(re.partial_dfa.cache.values())
+        front = list(found)
+        while front:
+            for state in front.pop().next.values():
+                if state not in found:
+                    found.add(state)
+                    front.append(state)
+        self.assertLessEqual(len(found), 8)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, lambda: Regex("a", engine="x"))
+        self.assertRaises(
+            ValueError, lambda: Regex("a", engine="lazy", dfa_eviction="x")
+        )
+
+
+class TestDFA(unittest.TestCase):
+    def test_minimized(self):
+        # start, after "a", after "ab", after "abb" and the dead state
+        self.assertEqual(Regex("(a|b)*abb", engine="dfa").dfa.state_count, 5)
+        self.assertEqual(
+            Regex("b(a|aa)*", engine="dfa").dfa.state_count,
+            Regex("ba*", engine="dfa").dfa.state_count,
+        )
+
+    def test_too_many_states(self):
+        self.assertRaises(
+            ValueError, lambda: Regex("[ab]*a[ab]{8}", engine="dfa", max_dfa_states=100)
+        )
+
+    def test_options_checked(self):
+        for engine in Regex.ENGINES:
+            for max_dfa_states in [1, 0, -1]:
+                self.assertRaisesRegex(
+                    ValueError,
+                    "at least 2",
+                    Regex,
+                    "a+b",
+                    engine=engine,
+                    max_dfa_states=max_dfa_states,
+                )
+            self.assertRaisesRegex(
+                ValueError, "eviction", Regex, "a", engine=engine, dfa_eviction="x"
+            )
+        self.assertRaisesRegex(
+            ValueError, "at least 2", Regex.load, Regex("a").dump(), max_dfa_states=1
+        )
+
+
+class TestGlushkov(unittest.TestCase):
+    def test_no_epsilons(self):
+        auto = Parser(lexer("(a|bc)*d?"), construction="glushkov").parse()
+        nodes = reachable(auto.start)
+        # One node per character position, plus start and end
+        self.assertEqual(len(nodes), 6)
+        for node in nodes:
+            self.assertTrue(node.trivial_neigbours <= {auto.end})
+
+    def test_same_language(self):
+        for needle in ["(a|bc)*d?", "(a|)*b", "(ab|a)+", "a{2,3}|b*", ""]:
+            thompson = Parser(lexer(needle)).parse()
+            glushkov = Parser(lexer(needle), construction="glushkov").parse()
+            thompson = CompiledAutomaton.compile(optimize_automaton(thompson))
+            glushkov = CompiledAutomaton.compile(optimize_automaton(glushkov))
+            for haystack in ["", "a", "b", "bcad", "ab", "aa", "aaa", "bbb", "d"]:
+                self.assertEqual(
+                    glushkov.match(haystack), thompson.match(haystack), needle
+                )
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, Parser(lexer("a"), construction="x").parse)
+
+
+class TestClosures(unittest.TestCase):
+    def test_trivial_cycle(self):
+        re = Regex("(a|)*b")
+        self.assertTrue(re.full_match("b"))
+        self.assertTrue(re.full_match("aaab"))
+        self.assertFalse(re.full_match("aaa"))
+
+    def test_closure(self):
+        auto = optimize_automaton(Parser(lexer("(x+x+)+y")).parse())
+        self.assertIn(auto.start, auto.start.closure)
+        self.assertNotIn(auto.end, auto.start.closure)
+        auto = optimize_automaton(Parser(lexer("(a|)*")).parse())
+        self.assertIn(auto.end, auto.start.closure)
+
+
+class TestCompiled(unittest.TestCase):
+    def test_states_are_integers(self):
+        re = Regex("(ab|a.c)*")
+        compiled = re.state_machine
+        self.assertTrue(all(0 <= s < compiled.size for s in compiled.start_states()))
+        self.assertEqual(len(compiled.offsets), compiled.size + 1)
+        self.assertEqual(len(compiled.edges), len(compiled.targets))
+        self.assertTrue(re.full_match("ababaxc"))
+        self.assertFalse(re.full_match("ababax"))
+
+    def test_variable_from_compiled(self):
+        word = Regex("[ab]+c?")
+        re = Regex("{word}(-{word})*", word=word)
+        self.assertTrue(re.full_match("ab-bbc-a"))
+        self.assertFalse(re.full_match("ab--a"))
+        self.assertFalse(re.full_match("abc-"))
+
+    def test_unanchored(self):
+        cases = {
+            "ab": ["xaby", "ab", "a", "ba"],
+            "^ab": ["abx", "xab"],
+            "ab$": ["xab", "abx"],
+            "a*": ["", "b"],
+        }
+        for needle, haystacks in cases.items():
+            re = Regex(needle)
+            for haystack in haystacks:
+                self.assertEqual(
+                    re.partial_state_machine.match(haystack),
+                    std_re.search(needle, haystack) is not None,
+                    (needle, haystack),
+                )
+
+
+class TestCharClass(unittest.TestCase):
+    def test_ranges(self):
+        self.assertEqual(
+            CharClass.from_chars("cabx").ranges, ((ord("a"), ord("c")), (120, 120))
+        )
+        self.assertEqual(CharClass.from_chars("").negate(), charclass.ANY)
+        self.assertIn("b", CharClass.from_chars("abc"))
+        self.assertNotIn("b", CharClass.from_chars("abc").negate())
+        self.assertIn("\u1234", CharClass.from_chars("abc").negate())
+
+    def test_wide_class(self):
+        re = Regex("[\u0000-\uffff]+x")
+        self.assertEqual(re.state_machine.n_classes, 3)
+        self.assertTrue(re.full_match("\u1234\uffffx"))
+        self.assertFalse(re.full_match("\U00010000x"))
+
+    def test_equivalence_classes(self):
+        re = Regex(r"\w+@\w+\.\w+")
+        # word characters, "@", "." and everything else
+        self.assertEqual(re.state_machine.n_classes, 4)
+
+    def test_unicode(self):
+        re = Regex("[^a-c]\u00e9")
+        self.assertTrue(re.full_match("\u20ac\u00e9"))
+        self.assertFalse(re.full_match("b\u00e9"))
+        self.assertFalse(re.full_match("\u20ac\u00ea"))
+
+
+class TestPrefilter(unittest.TestCase):
+    def test_literals(self):
+        self.assertEqual(Regex(r"\w+@\w+\.\w+").prefilter.literals, ("@", "."))
+        self.assertEqual(Regex("x(ab|cb)d").prefilter.literals, ("x", "d"))
+        self.assertEqual(Regex("ab+c").prefilter.literals, ("ab", "c"))
+        self.assertEqual(Regex("(a|b)xyz(c)*w").prefilter.literals, ("xyz", "w"))
+        self.assertIsNone(Regex("a*").prefilter)
+        self.assertIsNone(Regex("[ab]").prefilter)
+
+    def test_repeated_first_literal(self):
+        # The a right before the b is not the first a that is read
+        self.assertTrue(Regex("[cd]a+b").match("caab"))
+        self.assertTrue(Regex("[cd]a+b").match("caaab"))
+        self.assertTrue(Regex("[ab]c+d").match("accd"))
+
+    def test_reject(self):
+        re = Regex(r"\w+@\w+\.\w+")
+        self.assertFalse(re.match("no at sign. here"))
+        self.assertFalse(re.match("dot before@at"))
+        self.assertTrue(re.match("x info@bitstamp.net"))
+
+    def test_start(self):
+        re = Regex("[ab]{2}cd")
+        self.assertEqual(re.prefilter.max_prefix, 2)
+        self.assertTrue(re.match("zzzzabcd"))
+        self.assertTrue(re.match("cd bacd"))
+        self.assertFalse(re.match("zzacd"))
+
+    def test_anchored(self):
+        re = Regex("^a.cd")
+        self.assertTrue(re.match("abcd"))
+        self.assertFalse(re.match("xabcd"))
+        self.assertFalse(re.full_match("abc"))
+
+
+class TestRegexSet(unittest.TestCase):
+    def test_match(self):
+        res = RegexSet(["abc", "b+", "^x", "c$", "[0-9]"])
+        self.assertEqual(res.match("abc"), [0, 1, 3])
+        self.assertEqual(res.match("xbb1"), [1, 2, 4])
+        self.assertEqual(res.match("yyy"), [])
+
+    def test_full_match(self):
+        res = RegexSet(["a*", "ab", "a.", ""])
+        self.assertEqual(res.full_match(""), [0, 3])
+        self.assertEqual(res.full_match("ab"), [1, 2])
+        self.assertEqual(res.full_match("aaa"), [0])
+
+    def test_agrees_with_regex(self):
+        needles = ["a(b|c)*d", "^[a-c]+$", "(ab)+", "[^a]b", "\\d\\d"]
+        res = RegexSet(needles)
+        for haystack in ["abcd", "ad", "abab", "cb", "a12", "", "bbb"]:
+            expected = [i for i, n in enumerate(needles) if Regex(n).match(haystack)]
+            self.assertEqual(res.match(haystack), expected, haystack)
+
+    def test_variables(self):
+        digit = Regex("[0-9]")
+        res = RegexSet(["{digit}+", "x{digit}"], digit=digit)
+        self.assertEqual(res.full_match("123"), [0])
+        self.assertEqual(res.full_match("x1"), [1])
+
+    def test_empty(self):
+        self.assertEqual(RegexSet([]).match("abc"), [])
+
+
+class TestMatcher(unittest.TestCase):
+    def test_chunks(self):
+        m = Regex("ab+c").matcher()
+        self.assertIsNone(m.feed("xxa"))
+        self.assertIsNone(m.feed("bb"))
+        self.assertTrue(m.feed("cyy"))
+        self.assertTrue(m.finish())
+
+    def test_early_result(self):
+        self.assertFalse(Regex("^ab").matcher().feed("ac"))
+        self.assertTrue(Regex("a").matcher().feed("ba"))
+
+    def test_needs_finish(self):
+        m = Regex("a$").matcher()
+        self.assertIsNone(m.feed("ba"))
+        self.assertTrue(m.finish())
+        m = Regex("a$").matcher()
+        m.feed("ab")
+        self.assertFalse(m.finish())
+
+    def test_full(self):
+        re = Regex("(ab)*")
+        for chunks in (["a", "b", "ab"], ["aba"], [], ["ab", "", "c"]):
+            m = re.matcher(full=True)
+            for chunk in chunks:
+                m.feed(chunk)
+            self.assertEqual(m.finish(), re.full_match("".join(chunks)))
+
+    def test_empty_pattern(self):
+        self.assertTrue(Regex("").matcher().result)
+
+
+class TestScanFile(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "input.txt")
+        with open(self.path, "wb") as f:
+            f.write("foo bar\nbaz\nxföo\n\nfoo".encode())
+        self.empty = os.path.join(tmp.name, "empty.txt")
+        open(self.empty, "wb").close()
+
+    def test_lines(self):
+        self.assertEqual(
+            list(Regex("f.o").scan_file(self.path)),
+            [(1, 0, "foo bar"), (3, 12, "xföo"), (5, 19, "foo")],
+        )
+        self.assertEqual([n for n, _, _ in Regex("^foo$").scan_file(self.path)], [5])
+        self.assertEqual(
+            [n for n, _, _ in Regex("ba.").scan_file(self.path, full=True)], [2]
+        )
+        self.assertEqual([n for n, _, _ in Regex("^$").scan_file(self.path)], [4])
+        self.assertEqual(list(Regex("").scan_file(self.empty)), [])
+
+    def test_whole_file(self):
+        self.assertTrue(Regex("baz\nx").match_file(self.path))
+        self.assertTrue(Regex("föo").match_file(self.path, chunk_size=13))
+        self.assertFalse(Regex("qux").match_file(self.path))
+        self.assertFalse(Regex("foo").match_file(self.path, full=True))
+        self.assertTrue(Regex("").match_file(self.empty, full=True))
+
+    def test_main(self):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            self.assertEqual(main(["-c", "foo", self.path]), 0)
+            self.assertEqual(main(["ba", self.path]), 0)
+            self.assertEqual(main(["qux", self.path]), 1)
+        self.assertEqual(out.getvalue(), "2\n1:0:foo bar\n2:8:baz\n")
+
+
+class TestMatchMany(unittest.TestCase):
+    haystacks = ["ab", "xaby", "", "b", "aab"] * 7
+
+    def test_in_process(self):
+        re = Regex("a+b")
+        self.assertEqual(
+            list(re.match_many(self.haystacks)), [re.match(h) for h in self.haystacks]
+        )
+        self.assertEqual(
+            list(re.full_match_many(iter(self.haystacks))),
+            [re.full_match(h) for h in self.haystacks],
+        )
+
+    def test_pool(self):
+        re = Regex("a+b")
+        self.assertEqual(
+            list(re.match_many(self.haystacks, workers=2, chunksize=3)),
+            [re.match(h) for h in self.haystacks],
+        )
+        self.assertEqual(
+            list(re.full_match_many(iter(self.haystacks), workers=2, chunksize=4)),
+            [re.full_match(h) for h in self.haystacks],
+        )
+
+    def test_arguments(self):
+        self.assertRaises(ValueError, lambda: Regex("a").match_many([], workers=0))
+        self.assertRaises(ValueError, lambda: Regex("a").match_many([], chunksize=0))
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        regex.purge()
+        self.addCleanup(regex.purge)
+
+    def test_hits(self):
+        first = Regex("a+b")
+        second = Regex("a+b", engine="dfa")
+        self.assertIs(first.state_machine, second.state_machine)
+        self.assertEqual(regex.cache_info(), (1, 1, regex._MAXCACHE, 1))
+        self.assertIs(Regex("a+b", engine="dfa").dfa, second.dfa)
+        self.assertIsNot(Regex("a+b", engine="dfa", max_dfa_states=5).dfa, second.dfa)
+        self.assertEqual(regex.cache_info().hits, 3)
+        lazy = Regex("a+b", engine="lazy")
+        self.assertIsNot(Regex("a+b", engine="lazy").dfa, lazy.dfa)
+
+    def test_hit_skips_analyses(self):
+        first = Regex("a+b")
+        Regex("[ab]")
+        with unittest.mock.patch(
+            "regex.literal_string", side_effect=AssertionError
+        ), unittest.mock.patch("regex.single_class", side_effect=AssertionError):
+            self.assertEqual(Regex("a+b").engine, first.engine)
+            self.assertEqual(Regex("[ab]").engine, "class")
+            self.assertEqual(Regex("[ab]").char_class, frozenset("ab"))
+
+    def test_variables(self):
+        Regex("{x}y", x=Regex("a"))
+        Regex("{x}y", x=Regex("a"))
+        re = Regex("{x}y", x=Regex("b"))
+        self.assertTrue(re.full_match("by"))
+        self.assertEqual(regex.cache_info()[:2], (2, 4))
+
+    def test_lru(self):
+        with unittest.mock.patch("regex._MAXCACHE", 2):
+            Regex("a")
+            Regex("b")
+            Regex("a")
+            Regex("c")
+            self.assertEqual(list(k[0] for k in regex._cache), ["a", "c"])
+
+
+class TestDump(unittest.TestCase):
+    def test_round_trip(self):
+        haystacks = ["", "ab12", "xab12y", "é1", "ab", "12"]
+        for needle in ["ab[0-9]+", "^ab", "[^a]\\d$", "(ab|é)*1", "", "\\w+"]:
+            re = Regex(needle)
+            loaded = Regex.load(re.dump())
+            self.assertEqual(loaded.state_machine, re.state_machine)
+            self.assertEqual(loaded.prefilter, re.prefilter)
+            self.assertEqual(loaded.needle, needle)
+            for haystack in haystacks:
+                self.assertEqual(loaded.match(haystack), re.match(haystack))
+                self.assertEqual(loaded.full_match(haystack), re.full_match(haystack))
+
+    def test_engines(self):
+        data = Regex("a+b").dump()
+        for engine in Regex.ENGINES:
+            self.assertTrue(Regex.load(data, engine=engine).match("xaab"))
+
+    def test_mmap(self):
+        with tempfile.TemporaryFile() as f:
+            f.write(Regex("é+x", engine="dfa").dump())
+            f.flush()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                re = Regex.load(data)
+        self.assertTrue(re.match("aéééx"))
+        self.assertFalse(re.match("aééé"))
+
+    def test_invalid(self):
+        data = Regex("a").dump()
+        self.assertRaisesRegex(
+            ValueError, "Not a compiled regex", Regex.load, b"xx" + data
+        )
+        newer = data[:4] + struct.pack("<H", regex.FORMAT_VERSION + 1) + data[6:]
+        self.assertRaisesRegex(ValueError, "format version", Regex.load, newer)
+        for end in [3, 20, len(data) - 1]:
+            self.assertRaisesRegex(ValueError, "Truncated", Regex.load, data[:end])
+
+    def test_vars_groups(self):
+        re = Regex("a({x})b", x=Regex("c+"))
+        loaded = Regex.load(re.dump())
+        self.assertEqual(loaded.groups("xacccb"), ("ccc",))
+        self.assertEqual(loaded.groups("xacccb"), re.groups("xacccb"))
+
+
+class TestEngineSelection(unittest.TestCase):
+    def test_chosen(self):
+        self.assertEqual(Regex("abc").engine, "literal")
+        self.assertEqual(Regex("(ab)c{2}").engine, "literal")
+        self.assertEqual(Regex("[a-c]").engine, "class")
+        self.assertEqual(Regex("a|\\d").engine, "class")
+        self.assertEqual(Regex("ab*").engine, "bits")
+        self.assertEqual(Regex("a{70}b*").engine, "nfa")
+        self.assertEqual(Regex("abc", engine="dfa").engine, "dfa")
+
+    def test_literal(self):
+        for needle, haystack, expected in [
+            ("ab", "xaby", True),
+            ("^ab", "xab", False),
+            ("^ab", "abx", True),
+            ("ab$", "xab", True),
+            ("ab$", "abx", False),
+            ("^ab$", "ab", True),
+            ("", "x", True),
+        ]:
+            self.assertEqual(Regex(needle).match(haystack), expected, needle)
+        self.assertTrue(Regex("ab").full_match("ab"))
+        self.assertFalse(Regex("ab").full_match("abab"))
+
+    def test_class(self):
+        for needle, haystack, expected in [
+            ("[ab]", "xxb", True),
+            ("[ab]", "xyz", False),
+            ("^[ab]", "bx", True),
+            ("^[ab]", "xb", False),
+            ("[ab]$", "xb", True),
+            ("^[ab]$", "ab", False),
+            ("^[ab]$", "", False),
+            (".", "\U0001f600", True),
+            (".", "", False),
+        ]:
+            self.assertEqual(Regex(needle).match(haystack), expected, needle)
+        self.assertIsInstance(Regex("[a-z]").char_class, frozenset)
+        self.assertTrue(Regex(".").full_match("é"))
+        self.assertFalse(Regex("[^a]").full_match("a"))
+        self.assertFalse(Regex("[ab]").full_match("ab"))
+
+
+class TestQuickReject(unittest.TestCase):
+    def test_length_bounds(self):
+        cases = {
+            "abc": (3, 3),
+            "a{2,5}b": (3, 6),
+            "a(b|cd)e": (3, 4),
+            "a*": (0, None),
+            "(ab)*c": (1, None),
+            "": (0, 0),
+        }
+        for needle, bounds in cases.items():
+            regex = Regex(needle, engine="nfa")
+            self.assertEqual((regex.min_length, regex.max_length), bounds, needle)
+            self.assertEqual(length_bounds(regex.state_machine), bounds, needle)
+
+    def test_first_chars(self):
+        self.assertEqual(
+            first_chars(Regex("(ab|cd)+e").state_machine),
+            CharClass.from_chars("ac"),
+        )
+        self.assertIsNone(first_chars(Regex("a*b?").state_machine))
+        self.assertEqual(Regex("q\\d+").first_chars, "q")
+        # Too many characters to search for one by one
+        self.assertIsNone(Regex("\\d+q").first_chars)
+
+    def test_full_match_rejects_by_length(self):
+        regex = Regex("a{3,5}b")
+        with unittest.mock.patch.object(
+            CompiledAutomaton, "match", side_effect=AssertionError
+        ):
+            self.assertFalse(regex.full_match("a" * 100))
+            self.assertFalse(regex.full_match("ab"))
+
+    def test_match_starts_at_first_chars(self):
+        regex = Regex("(ab|cd)+e")
+        self.assertTrue(regex.match("x" * 1000 + "cdabe"))
+        self.assertTrue(regex.match("abcde"))
+        self.assertFalse(regex.match("x" * 1000 + "cdab"))
+        self.assertFalse(regex.match("xyz"))
+        self.assertTrue(Regex("^ab+").match("abb"))
+        self.assertFalse(Regex("^ab+").match("xab"))
+
+
+class TestSearch(unittest.TestCase):
+    def test_search(self):
+        regex = Regex("\\w+@\\w+\\.\\w+")
+        self.assertEqual(regex.search("mail bob@example.com now"), (5, 20))
+        self.assertIsNone(regex.search("mail bob at example.com"))
+
+    def test_leftmost_longest(self):
+        self.assertEqual(Regex("abcd|c").search("abcd"), (0, 4))
+        self.assertEqual(Regex("a|ab").search("xab"), (1, 3))
+        self.assertEqual(Regex("b+").search("abbbc"), (1, 4))
+
+    def test_finditer(self):
+        self.assertEqual(
+            list(Regex("ab+").finditer("abxabbbab")), [(0, 2), (3, 7), (7, 9)]
+        )
+        self.assertEqual(list(Regex("a*").finditer("baa")), [(0, 0), (1, 3), (3, 3)])
+        self.assertEqual(list(Regex("ab").finditer("xx")), [])
+
+    def test_anchors(self):
+        self.assertEqual(list(Regex("^a+").finditer("aaba")), [(0, 2)])
+        self.assertEqual(list(Regex("a+$").finditer("aaba")), [(3, 4)])
+        self.assertEqual(list(Regex("^a.*$").finditer("aab")), [(0, 3)])
+        self.assertIsNone(Regex("^b").search("ab"))
+
+    def test_reverse(self):
+        auto = Parser(lexer("ab+c")).parse().reverse()
+        compiled = CompiledAutomaton.compile(optimize_automaton(auto))
+        self.assertTrue(compiled.match("cbba"))
+        self.assertFalse(compiled.match("abbc"))
+
+    def test_linear(self):
+        # Every match start could be followed by a long match that never ends
+        haystack = "a" * 20000
+        spans = list(Regex("a+b|a", engine="nfa").finditer(haystack))
+        self.assertEqual(spans, [(i, i + 1) for i in range(20000)])
+        self.assertEqual(list(Regex("a+b|a").finditer("aaab")), [(0, 4)])
+
+
+class TestGroups(unittest.TestCase):
+    def test_groups(self):
+        regex = Regex("(\\w+)@(\\w+)\\.(\\w+)")
+        self.assertEqual(
+            regex.groups("mail bob@example.com now"), ("bob", "example", "com")
+        )
+        self.assertIsNone(regex.groups("no mail"))
+        self.assertEqual(Regex("abc").groups("xabc"), ())
+
+    def test_unmatched_group(self):
+        self.assertEqual(Regex("x(y)?z").groups("xz"), (None,))
+        self.assertEqual(Regex("((a)|b)+").groups("ab"), ("b", "a"))
+
+    def test_priorities(self):
+        # Within the match, the groups are the ones a backtracking engine finds
+        for needle, haystack in [
+            ("(a|ab)(c|bcd)(d*)", "abcd"),
+            ("(a*)(a*)", "aaa"),
+            ("(a+)(a+)", "aaaa"),
+            ("(a{2,3})(a*)", "aaaaa"),
+            ("(ab)*c", "ababc"),
+        ]:
+            expected = std_re.fullmatch(needle, haystack).groups()
+            self.assertEqual(Regex(needle).groups(haystack), expected, needle)
+
+    def test_nested_count(self):
+        parser = Parser(lexer("((a)(b))|(c)"))
+        parser.parse()
+        self.assertEqual(parser.groups, 4)
+
+    def test_linear(self):
+        # Exponential for backtracking engines
+        regex = Regex("(x+x+)+y")
+        self.assertEqual(regex.groups("x" * 500 + "y"), ("x" * 500,))
+        self.assertIsNone(regex.groups("x" * 500))
+
+
+class TestEarlyExit(unittest.TestCase):
+    @staticmethod
+    def haystack():
+        # Reading past the match fails the test
+        yield from "xxkeyxx"
+        raise AssertionError("read past the match")
+
+    def test_nfa(self):
+        regex = Regex("key", engine="nfa")
+        states = regex.partial_state_machine.run(
+            self.haystack(), stop=regex.partial_universal
+        )
+        self.assertTrue(regex.partial_state_machine.accepts(states))
+        self.assertTrue(regex.match("key" + "x" * 100000))
+
+    def test_dfas(self):
+        for engine in ("lazy", "dfa"):
+            regex = Regex("key", engine=engine)
+            state = regex.partial_dfa.run(self.haystack())
+            if engine == "lazy":
+                self.assertTrue(state.final and state.accepting)
+            else:
+                self.assertTrue(regex.partial_dfa.accepting[state])
+        dfa = Regex("a.*", engine="dfa").dfa
+        self.assertTrue(dfa.accepting[dfa.run("ab" + "c" * 10)])
+        self.assertGreaterEqual(dfa.run("ab"), dfa.stop)
+
+    def test_matcher(self):
+        for engine in ("nfa", "lazy", "dfa"):
+            matcher = Regex("key", engine=engine).matcher()
+            self.assertTrue(matcher.feed("xxkeyxx"))
+
+    def test_dead_states(self):
+        auto = Automaton.literal("a")
+        dead = Node()
+        auto.start.connect_literal("b", dead)
+        dead.connect_literal("c", Node())
+        compiled = CompiledAutomaton.compile(optimize_automaton(auto))
+        self.assertEqual(compiled.size, 2)
+        self.assertTrue(compiled.match("a"))
+        self.assertFalse(compiled.match("bc"))
+        self.assertEqual(compiled.run("b"), set())
+
+
+class TestMemory(unittest.TestCase):
+    def test_node_match_is_read_only(self):
+        auto = Parser(lexer("a[b-d]")).parse()
+        node = auto.start
+        self.assertEqual(len(node.match("a")), 1)
+        self.assertEqual(node.match("x"), set())
+        self.assertEqual(list(node.transitions), ["a"])
+
+    def test_flat_memory(self):
+        # Over a million distinct characters, none of them may stay behind
+        first = "".join(map(chr, range(0x100, 0x100 + 550000)))
+        second = "".join(map(chr, range(0x100 + 550000, 0x100 + 1100000)))
+        for engine in ("auto", "lazy", "dfa", "bits", "nfa"):
+            regex = Regex("\\w+\\d", engine=engine)
+            self.assertFalse(regex.match(first))
+            tracemalloc.start()
+            try:
+                before = tracemalloc.get_traced_memory()[0]
+                self.assertFalse(regex.match(second))
+                self.assertFalse(regex.full_match(second))
+                after = tracemalloc.get_traced_memory()[0]
+            finally:
+                tracemalloc.stop()
+            self.assertLess(after - before, 10000, engine)
+
+
+class TestBitNFA(unittest.TestCase):
+    def test_states_are_bits(self):
+        regex = Regex("ab*c", engine="bits")
+        state = regex.dfa.run("ab")
+        self.assertEqual(
+            {s for s in range(regex.state_machine.size) if state >> s & 1},
+            regex.state_machine.run("ab"),
+        )
+        self.assertEqual(regex.dfa.run("ax"), 0)
+
+    def test_tables_hold_edges(self):
+        regex = Regex("a[ab]{20}c", engine="bits")
+        self.assertTrue(regex.full_match("a" + "ab" * 10 + "c"))
+        self.assertFalse(regex.full_match("a" + "ab" * 10 + "bc"))
+        self.assertTrue(regex.match("xx" + "a" * 21 + "cxx"))
+        # One entry per edge, states without an edge on a class have none
+        for dfa in (regex.dfa, regex.partial_dfa):
+            entries = sum(len(t[1]) for t in dfa.tables if t is not None)
+            self.assertLessEqual(entries, len(dfa.automaton.edges))
+
+    def test_auto_within_cap(self):
+        # "auto" only picks bits when the automaton fits the caller's cap
+        self.assertEqual(Regex("ab*c", max_dfa_states=3).engine, "nfa")
+        self.assertTrue(Regex("a.*b", max_dfa_states=3).match("xaxxb"))
+        self.assertEqual(Regex("ab*c", max_dfa_states=64).engine, "bits")
+
+    def test_default_memory(self):
+        # About what the nfa engine needs, not a table per byte of states
+        words = ["alp", "bra", "cha", "del", "ech", "fox", "gol", "hot", "ind"]
+        needle = "(" + "|".join(words + ["jul", "kil", "lim", "mik"]) + ")[0-9]"
+        haystacks = [f"x {word}7 y {word}" for word in words]
+        sizes = {}
+        for engine in ["nfa", "auto", "nfa"]:
+            regex.purge()
+            tracemalloc.start()
+            try:
+                compiled = Regex(needle, engine=engine)
+                for haystack in haystacks:
+                    compiled.match(haystack)
+                    compiled.full_match(haystack)
+                sizes[engine] = tracemalloc.get_traced_memory()[0]
+            finally:
+                tracemalloc.stop()
+            regex.purge()
+        self.assertEqual(Regex(needle).engine, "bits")
+        self.assertLess(sizes["auto"], 2 * sizes["nfa"])
+
+    def test_too_large(self):
+        self.assertRaisesRegex(
+            ValueError, "more than 64 states", Regex, "a{70}b", engine="bits"
+        )
+        # The cap is checked even when a larger one already built the tables
+        Regex("a{20}b", engine="bits")
+        self.assertRaisesRegex(
+            ValueError,
+            "more than 8 states",
+            Regex,
+            "a{20}b",
+            engine="bits",
+            max_dfa_states=8,
+        )
+
+    def test_matcher(self):
+        matcher = Regex("ab+c", engine="bits").matcher()
+        self.assertIsNone(matcher.feed("xxab"))
+        self.assertTrue(matcher.feed("bbcx"))
+        self.assertFalse(Regex("ab", engine="bits").matcher(full=True).finish())
+
+
+class TestVectorized(unittest.TestCase):
+    @unittest.skipIf(vectorized.np is None, "numpy is not installed")
+    def test_same_as_match(self):
+        haystacks = ["", "abc", "xab9", "ab" * 20, "é9", "zzzz", "a\x00b"]
+        for needle in ["[a-z_][a-z0-9_]*", "x.*9", "^ab", "é\\d$", "b$", ""]:
+            regex = Regex(needle)
+            for full in (False, True):
+                many = regex.full_match_many if full else regex.match_many
+                check = regex.full_match if full else regex.match
+                self.assertEqual(
+                    list(many(haystacks, chunksize=3, vectorized=True)),
+                    [check(haystack) for haystack in haystacks],
+                    needle,
+                )
+
+    @unittest.skipIf(vectorized.np is None, "numpy is not installed")
+    def test_batch_dfa(self):
+        batch = vectorized.BatchDFA(Regex("ab+", engine="dfa").dfa)
+        self.assertEqual(batch.classes(["ab", ""]).shape, (2, 2))
+        self.assertEqual(
+            batch.match(["ab", "abb", "a", ""]).tolist(), [True, True, False, False]
+        )
+        self.assertEqual(batch.match([]).tolist(), [])
+
+    def test_too_large(self):
+        # Over `DFA.MAX_STATES` states, the haystacks are matched one by one
+        regex = Regex("(a|b)*a(a|b){14}")
+        haystacks = ["a" * 15, "b" * 15, "ab" * 10]
+        for full in (False, True):
+            many = regex.full_match_many if full else regex.match_many
+            check = regex.full_match if full else regex.match
+            self.assertEqual(
+                list(many(haystacks, vectorized=True)),
+                [check(haystack) for haystack in haystacks],
+            )
+
+    def test_without_numpy(self):
+        regex = Regex("ab")
+        with unittest.mock.patch.object(vectorized, "np", None):
+            self.assertRaisesRegex(
+                ImportError,
+                "numpy",
+                vectorized.BatchDFA,
+                Regex("ab+", engine="dfa").dfa,
+            )
+        self.assertRaisesRegex(
+            ValueError,
+            "one process",
+            regex.match_many,
+            ["ab"],
+            workers=2,
+            vectorized=True,
+        )
+
+
 """
 b(?![^@]+@[^@]+).
 ([-!#-'*+/-9=?A-Z^-~]+(\.[-!#-'*+/-9=?A-Z^-~]+)*|"([]!#-[^-~ \t]|(\\[\t -~]))+")@([0-9A-Za-z]([0-9A-Za-z-]{0,61}[0-9A-Za-z])?(\.[0-9A-Za-z]([0-9A-Za-z-]{0,61}[0-9A-Za-z])?)*|\[((25[0-5]|2[0-4][0-9]|1[0-9]{2}|[1-9]?[0-9])(\.(25[0-5]|2[0-4][0-9]|1[0-9]{2}|[1-9]?[0-9])){3}|IPv6:((((0|[1-9A-Fa-f][0-9A-Fa-f]{0,3}):){6}|::((0|[1-9A-Fa-f][0-9A-Fa-f]{0,3}):){5}|[0-9A-Fa-f]{0,4}::((0|[1-9A-Fa-f][0-9A-Fa-f]{0,3}):){4}|(((0|[1-9A-Fa-f][0-9A-Fa-f]{0,3}):)?(0|[1-9A-Fa-f][0-9A-Fa-f]{0,3}))?::((0|[1-9A-Fa-f][0-9A-Fa-f]{0,3}):){3}|(((0|[1-9A-Fa-f][0-9A-Fa-f]{0,3}):){0,2}(0|[1-9A-Fa-f][0-9A-Fa-f]{0,3}))?::((0|[1-9A-Fa-f][0-9A-Fa-f]{0,3}):){2}|(((0|[1-9A-Fa-f][0-9A-Fa-f]{0,3}):){0,3}(0|[1-9A-Fa-f][0-9A-Fa-f]{0,3}))?::(0|[1-9A-Fa-f][0-9A-Fa-f]{0,3}):|(((0|[1-9A-Fa-f][0-9A-Fa-f]{0,3}):){0,4}(0|[1-9A-Fa-f][0-9A-Fa-f]{0,3}))?::)((0|[1-9A-Fa-f][0-9A-Fa-f]{0,3}):(0|[1-9A-Fa-f][0-9A-Fa-f]{0,3})|(25[0-5]|2[0-4][0-9]|1[0-9]{2}|[1-9]?[0-9])(\.(25[0-5]|2[0-4][0-9]|1[0-9]{2}|[1-9]?[0-9])){3})|(((0|[1-9A-Fa-f][0-9A-Fa-f]{0,3}):){0,5}(0|[1-9A-Fa-f][0-9A-Fa-f]{0,3}))?::(0|[1-9A-Fa-f][0-9A-Fa-f]{0,3})|(((0|[1-9A-Fa-f][0-9A-Fa-f]{0,3}):){0,6}(0|[1-9A-Fa-f][0-9A-Fa-f]{0,3}))?::)|(?!IPv6:)[0-9A-Za-z-]*[0-9A-Za-z]:[!-Z^-~]+)])
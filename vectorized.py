@@ -0,0 +1,71 @@
+from collections.abc import Sequence
+
+from dfa import DFA
+
+try:
+    import numpy as np
+except ImportError:  # Optional, only `BatchDFA` needs it
+    np = None
+
+
+class BatchDFA:
+    """
+    Runs a `DFA` over many haystacks in lockstep with NumPy. The transition
+    table becomes an `int32` matrix indexed by state and character class, a
+    batch becomes a matrix of character classes with one row per haystack,
+    and every column advances all states with a single fancy-indexing step.
+
+    Rows are padded with an extra class that leaves every state as it is, so
+    haystacks of different lengths can share a batch.
+    """
+
+    def __init__(self, dfa: DFA):
+        if np is None:
+            raise ImportError("The vectorized backend needs numpy")
+        n = dfa.n_classes
+        table = np.array(dfa.table, dtype=np.int32).reshape(-1, n)
+        keep = np.arange(len(table), dtype=np.int32)[:, None]
+        self.table = np.hstack([table, keep])
+        self.pad = n
+        self.start = dfa.start
+        self.stop = dfa.stop
+        self.accepting = np.array(dfa.accepting, dtype=bool)
+        auto = dfa.automaton
+        self.ascii_classes = np.array(list(auto.ascii_classes), dtype=np.int32)
+        self.boundaries = np.array(auto.boundaries, dtype=np.int64)
+        self.class_map = np.array(auto.class_map, dtype=np.int32)
+
+    def match(self, haystacks: Sequence[str]) -> "np.ndarray":
+        """Whether the DFA accepts each haystack, as a boolean array."""
+        return self.accepting[self.run(haystacks)]
+
+    def run(self, haystacks: Sequence[str]) -> "np.ndarray":
+        """The state after reading each haystack."""
+        classes = self.classes(haystacks)
+        states = np.full(len(haystacks), self.start, dtype=np.int32)
+        table, stop = self.table, self.stop
+        for column in classes.T:
+            states = table[states, column]
+            # Every state is final, the rest of the batch can't change them
+            if stop < len(table) and (states >= stop).all():
+                break
+        return states
+
+    def classes(self, haystacks: Sequence[str]) -> "np.ndarray":
+        """The character classes of a batch, padded to its longest haystack."""
+        lengths = np.fromiter(map(len, haystacks), dtype=np.int64, count=len(haystacks))
+        width = int(lengths.max(initial=0))
+        if width == 0:
+            return np.empty((len(haystacks), 0), dtype=np.int32)
+        # Fixed-width unicode is UCS-4, one code point per uint32
+        codes = np.array(haystacks, dtype=f"<U{width}").view(np.uint32)
+        codes = codes.reshape(len(haystacks), width)
+        # A lookup for ASCII, a binary search over the boundaries for the rest
+        classes = self.ascii_classes[np.minimum(codes, 127)]
+        wide = codes > 127
+        if wide.any():
+            classes[wide] = self.class_map[
+                np.searchsorted(self.boundaries, codes[wide], side="right") - 1
+            ]
+        classes[np.arange(width) >= lengths[:, None]] = self.pad
+        return classes